@@ -1,38 +1,1305 @@
 # app.py
 # A real-time chat server using Flask with support for Emojis, GIFs, and ephemeral image uploads.
-# - Group chat support with hardcoded passwords.
+# - Group chat with password-protected groups, managed at runtime through the /admin API.
 # - Option to go back to group selection.
-# - Image sharing via Base64 encoding (images are stored in memory and disappear on restart).
+# - Image sharing via a content-addressed blob store served from /media/<hash>.
+# - Messages and images are kept in memory and disappear on restart, unless CHAT_DATA_DIR
+#   points at a directory for the append-only message log.
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify
+import cProfile
 import datetime
+import functools
+import multiprocessing
 import bcrypt
+import gzip
 import json
-import base64 # <-- Required for image encoding
+import hashlib
+import itertools
+import mimetypes
+import os
+import random
+import re
+import secrets
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from broker import Broker, BrokerUnavailable, SocketBroker
+import images
+import metrics
+import presence
+import search
 
-# Initialize the Flask application
-app = Flask(__name__)
+try:
+    import brotli
+except ImportError:  # brotli is optional; without it responses are gzipped
+    brotli = None
 
-# Hardcoded groups with passwords
-GROUPS = {
+# Initialize the Flask application (static/ is served by get_static, with fingerprinted URLs)
+app = Flask(__name__, static_folder=None)
+
+# Groups created on first start, when there's no saved group registry yet. After that, groups are
+# created, deleted and given new passwords through the /admin API (see ADMIN_TOKEN).
+DEFAULT_GROUPS = {
     "friends": "$2b$12$VjDjD89wDO6suFTcA6yF7OVtK1eolxSR39n4wGQEK6jgY.0BKe.Hq",
     "family": "$2b$12$Us2ERFfYOsiWDKetbmNXjun9JLIo1PU1TxGkErZo5vpgtc.ibfLvS",
     "work": "$2b$12$qT0mZNQYkbB3lIzQ2dk8CO5fP7wdsKpb1nocTtmKGHBFlBKRIbUEW",
     "gaming": "$2b$12$c6657YRENwKCVcCS06ALwuQB9o5Zk90rAXXcr6s4zIMQC3RFrZRtK",
 }
 
-# Messages stored per group (in-memory). Start each group with a welcome message.
-messages = {}
-for g in GROUPS:
-    messages[g] = [
-        {
-            'username': 'ChatBot',
-            'text': f'Welcome to the {g} group! Say hi 👋',
-            'timestamp': datetime.datetime.now().strftime('%H:%M')
+# Max messages returned by a single GET /messages call.
+DEFAULT_FETCH_LIMIT = 100
+MAX_FETCH_LIMIT = 500
+# Seconds between keepalive comments on an idle /stream, and the longest a long-poll may wait.
+STREAM_KEEPALIVE = 15
+MAX_LONG_POLL_WAIT = 30
+
+# Memory limits (override with environment variables). Each group keeps at most
+# MAX_MESSAGES_PER_GROUP messages / MAX_BYTES_PER_GROUP bytes of history, and everything
+# held in memory (all histories plus uploaded media) is kept under MEMORY_BUDGET_BYTES.
+MAX_MESSAGES_PER_GROUP = int(os.environ.get('CHAT_MAX_MESSAGES_PER_GROUP', 1000))
+MAX_BYTES_PER_GROUP = int(os.environ.get('CHAT_MAX_BYTES_PER_GROUP', 1024 * 1024))
+MEMORY_BUDGET_BYTES = int(os.environ.get('CHAT_MEMORY_BUDGET_BYTES', 256 * 1024 * 1024))
+# Rough per-message cost of a Message, its id and time, and its history slot, on top of the
+# text (see `python bench.py --memory`).
+MESSAGE_OVERHEAD_BYTES = 200
+
+# Counters for sizing the limits above (exposed on /stats).
+stats = {
+    'evicted_messages': 0,
+    'evicted_media': 0,
+    'media_bytes': 0,
+}
+
+# One lock guards all histories and the media store. Each group also gets a condition
+# on this lock, so waiting streams only wake for their own group.
+store_lock = threading.Lock()
+
+def message_size(message):
+    """Approximate number of bytes a stored message holds (usernames are shared, so not counted)."""
+    return MESSAGE_OVERHEAD_BYTES + len(message.text.encode()) + len(message.full or '')
+
+def valid_message(username, text):
+    """True if a post's username and text are non-empty strings, the only kind the store takes."""
+    return isinstance(username, str) and isinstance(text, str) and username != '' and text != ''
+
+# A post may carry a key chosen by its client. Each group remembers the last RECENT_POST_KEYS and
+# doesn't store a post whose key it already has (a resend after a dropped connection) again.
+MAX_POST_KEY_LENGTH = 64
+RECENT_POST_KEYS = 256
+
+def valid_post_key(key):
+    return key is None or (isinstance(key, str) and 0 < len(key) <= MAX_POST_KEY_LENGTH)
+
+@functools.lru_cache(maxsize=1024)
+def format_minute(minute):
+    return datetime.datetime.fromtimestamp(minute * 60).strftime('%H:%M')
+
+class Message:
+    """A stored chat message.
+
+    Much smaller than the equivalent dict: no per-message key table, one shared string per
+    username, and the time kept as an int that is only formatted for clients. `created` is a
+    Unix time (or an 'HH:MM' string, for records logged before times were kept as numbers);
+    `full` is an optional link to the full-size version of an image.
+    """
+
+    __slots__ = ('id', 'username', 'text', 'created', 'full')
+
+    def __init__(self, message_id, username, text, created, full=None):
+        self.id = message_id
+        self.username = sys.intern(username) if isinstance(username, str) else username
+        self.text = text
+        self.created = created
+        self.full = full
+
+    def timestamp(self):
+        return self.created if isinstance(self.created, str) else format_minute(self.created // 60)
+
+    def to_dict(self):
+        """The message as clients see it."""
+        message = {'id': self.id, 'username': self.username, 'text': self.text, 'timestamp': self.timestamp()}
+        if self.full:
+            message['full'] = self.full
+        return message
+
+    def to_row(self):
+        """The message as a list of MESSAGE_FIELDS, for compact pages (`full` only when set)."""
+        row = [self.id, self.username, self.text, self.timestamp()]
+        if self.full:
+            row.append(self.full)
+        return row
+
+    def record(self):
+        """The message as it's written to the log and sent between processes."""
+        record = {'id': self.id, 'username': self.username, 'text': self.text, 'created': self.created}
+        if self.full:
+            record['full'] = self.full
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['id'], record['username'], record['text'],
+                   record.get('created', record.get('timestamp')), record.get('full'))
+
+# Each history's versions start at a new multiple of 2**32, so a group that's woken from hibernation
+# (or deleted and created again) never reuses a version of its earlier history in the response cache.
+history_generations = itertools.count(1)
+
+class MessageHistory:
+    """A group's recent messages in a fixed-size ring buffer, capped by count and bytes.
+
+    Every message gets a per-group sequence id (1, 2, 3, ...) so clients can poll with a
+    cursor. Ids are contiguous, so any id maps straight to a slot in O(1).
+    """
+
+    def __init__(self, max_messages, max_bytes):
+        self.slots = [None] * max_messages
+        self.max_bytes = max_bytes
+        self.start = 0      # slot of the oldest message
+        self.count = 0
+        self.bytes = 0
+        self.last_id = 0
+        # Bumped on every append or eviction; keys the response cache
+        self.version = next(history_generations) << 32
+        self.new_message = threading.Condition(store_lock)
+        self.index = search.SearchIndex()
+        self.evicted = 0
+        # Last time a request used the group (see open_group); idle groups are hibernated
+        self.touched = time.monotonic()
+        # Post key -> stored message, for the posts that carried one (see store_messages)
+        self.post_keys = OrderedDict()
+
+    def first_id(self):
+        return self.last_id - self.count + 1
+
+    def append(self, message):
+        # Sized before anything changes, so a bad message can't leave the ring half-updated
+        size = message_size(message)
+        if self.count == len(self.slots):
+            self.evict_oldest()
+        self.slots[(self.start + self.count) % len(self.slots)] = message
+        self.count += 1
+        self.bytes += size
+        self.version += 1
+        self.index.add(message)
+        # Always keep the newest message, even if it alone is over the byte cap
+        while self.bytes > self.max_bytes and self.count > 1:
+            self.evict_oldest()
+
+    def clear(self):
+        self.slots = [None] * len(self.slots)
+        self.start = 0
+        self.count = 0
+        self.bytes = 0
+        self.version += 1
+        self.index.clear()
+
+    def evict_oldest(self):
+        oldest = self.slots[self.start]
+        size = message_size(oldest)
+        self.slots[self.start] = None
+        self.start = (self.start + 1) % len(self.slots)
+        self.count -= 1
+        self.bytes -= size
+        self.version += 1
+        self.index.remove_oldest(oldest)
+        self.evicted += 1
+        stats['evicted_messages'] += 1
+
+    def remember_post_keys(self, keys):
+        self.post_keys.update(keys)
+        while len(self.post_keys) > RECENT_POST_KEYS:
+            self.post_keys.popitem(last=False)
+
+    def get(self, message_id):
+        """Returns the message with this id, or None if it isn't held."""
+        offset = message_id - self.first_id()
+        if not 0 <= offset < self.count:
+            return None
+        return self.slots[(self.start + offset) % len(self.slots)]
+
+    def after(self, since, limit):
+        """Returns up to `limit` messages with an id greater than `since`."""
+        offset = max(since - self.first_id() + 1, 0)
+        end = min(offset + limit, self.count)
+        return [self.slots[(self.start + i) % len(self.slots)] for i in range(offset, end)]
+
+    def before(self, before, limit):
+        """Returns up to `limit` messages with an id less than `before` (the newest of them), oldest first."""
+        end = min(before - self.first_id(), self.count)
+        start = max(end - limit, 0)
+        return [self.slots[(self.start + i) % len(self.slots)] for i in range(start, end)]
+
+# Histories of the groups loaded in this process, least recently used first (see open_group)
+messages = OrderedDict()
+# Callables run as listener(group, batch) after every batch of appends, while store_lock is held
+# (so they see messages in id order). Used to wake asyncio streams and feed broker.py.
+message_listeners = []
+
+# Most posts wait on something (the store lock, the broker, the log's fsync). Posts that arrive
+# for a group meanwhile queue up and are stored together by whichever poster leads next.
+class IngestTicket:
+    """One caller's entries in an IngestQueue, and what happened to them."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.done = threading.Event()
+        self.lead = False     # set when this caller is handed the leader role
+        self.messages = None
+        self.error = None
+
+class IngestQueue:
+    """Coalesces concurrent posts to one group into batches (leader/follower group commit).
+
+    The first poster to arrive becomes the leader and publishes everything queued so far as
+    one batch; later arrivals wait on their ticket. When the batch is done, the leader hands
+    the role to the oldest waiting poster, so no request keeps draining the queue for others.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.lock = threading.Lock()
+        self.pending = []
+        self.leading = False
+
+    def submit(self, entries):
+        """Publishes (username, text, full[, key]) entries and returns the stored messages.
+
+        Raises ValueError for invalid entries before they're queued, so they can't fail anyone else's batch.
+        """
+        if not all(valid_entry(entry) for entry in entries):
+            raise ValueError('every message needs a username and text')
+        ticket = IngestTicket(entries)
+        with self.lock:
+            self.pending.append(ticket)
+            follower = self.leading
+            self.leading = True
+        if follower:
+            ticket.done.wait()
+        if not follower or ticket.lead:
+            self.lead()
+        if ticket.error:
+            raise ticket.error
+        return ticket.messages
+
+    def lead(self):
+        with self.lock:
+            tickets, self.pending = self.pending, []
+        self.publish(tickets)
+        with self.lock:
+            if self.pending:
+                self.pending[0].lead = True
+                self.pending[0].done.set()
+            else:
+                self.leading = False
+        for ticket in tickets:
+            ticket.done.set()
+
+    def publish(self, tickets):
+        """Publishes the tickets' entries as one batch and tells each ticket what happened to its own."""
+        try:
+            stored = broker.publish(self.group, [entry for ticket in tickets for entry in ticket.entries])
+        except BrokerUnavailable as e:
+            # The broker may or may not have stored the batch; everyone in it gets to know that
+            for ticket in tickets:
+                ticket.error = e
+            return
+        except Exception as e:
+            if len(tickets) == 1:
+                tickets[0].error = e
+                return
+            # Nothing was stored (see store_messages), so try each ticket on its own: only the one at fault fails
+            for ticket in tickets:
+                self.publish([ticket])
+            return
+        for ticket in tickets:
+            ticket.messages, stored = stored[:len(ticket.entries)], stored[len(ticket.entries):]
+
+ingest_queues = {}
+
+def valid_entry(entry):
+    """True for a (username, text, full[, key]) entry the store can take; `full` is None or a link."""
+    return (isinstance(entry, (list, tuple)) and len(entry) in (3, 4) and valid_message(entry[0], entry[1])
+            and (entry[2] is None or isinstance(entry[2], str)) and valid_post_key(entry[3] if len(entry) == 4 else None))
+
+def append_message(group, username, text, full=None, key=None):
+    """Publishes a new message through the broker, which gives it the group's next id.
+
+    `full` is an optional link to the full-size version of an image message. A post whose `key`
+    the group has already stored returns the message stored then.
+    """
+    return append_messages(group, [(username, text, full, key)])[0]
+
+def append_messages(group, entries):
+    """Publishes (username, text, full[, key]) entries together with any other posts queued for the group."""
+    return ingest_queues[group].submit(entries)
+
+def store_messages(group, entries):
+    """Assigns the next sequence ids and appends a batch of messages to the group's history in one pass.
+
+    Stores the whole batch or, if anything in it fails, none of it. Returns one message per entry:
+    an entry whose key was already stored gets the earlier message instead of a new one.
+    """
+    if not all(valid_entry(entry) for entry in entries):
+        raise ValueError('every message needs a username and text')
+    with metrics.timed('store_append'), store_lock:
+        history = messages[group]
+        created = int(time.time())
+        stored, batch, keys = [], [], {}
+        for username, text, full, *key in entries:
+            key = key[0] if key else None
+            message = keys.get(key) or history.post_keys.get(key)
+            if message is None:
+                message = Message(history.last_id + len(batch) + 1, username, text, created, full)
+                batch.append(message)
+                if key is not None:
+                    keys[key] = message
+            stored.append(message)
+        if not batch:
+            return stored
+        # Logged before the history changes: a failed write leaves both as they were
+        log = message_logs.get(group)
+        if log:
+            synced_at = log.write(batch)
+        for message in batch:
+            history.last_id = message.id
+            history.append(message)
+        history.remember_post_keys(keys)
+        enforce_memory_budget()
+        # One wake-up per batch, however many messages it holds
+        history.new_message.notify_all()
+        for listener in message_listeners:
+            listener(group, batch)
+    if log:
+        with metrics.timed('log_sync_wait'):
+            log.wait_synced(synced_at)
+    metrics.inc('chat_ingest_batches_total', 'Batches of messages stored', group=group)
+    metrics.inc('chat_ingest_messages_total', 'Messages stored', amount=len(batch), group=group)
+    return stored
+
+def apply_messages(group, records):
+    """Appends messages that were sequenced by another process (see SocketBroker)."""
+    batch = [Message.from_record(record) for record in records]
+    with store_lock:
+        history = messages.get(group)
+        if history is None:
+            return  # Not loaded here; it's fetched whole when it's next used
+        applied = []
+        for message in batch:
+            if message.id <= history.last_id:
+                continue
+            if message.id != history.last_id + 1:
+                # Missed some messages; ids within the ring buffer must stay contiguous
+                history.clear()
+            history.last_id = message.id
+            history.append(message)
+            applied.append(message)
+        if not applied:
+            return
+        enforce_memory_budget()
+        history.new_message.notify_all()
+        for listener in message_listeners:
+            listener(group, applied)
+
+def apply_snapshot(group, snapshot):
+    """Replaces (or loads) a group's history with the broker's copy."""
+    batch = [Message.from_record(record) for record in snapshot]
+    with store_lock:
+        history = messages.get(group)
+        if history is None:
+            if group not in groups:
+                return
+            history = messages[group] = MessageHistory(MAX_MESSAGES_PER_GROUP, MAX_BYTES_PER_GROUP)
+        history.clear()
+        for message in batch:
+            history.last_id = message.id
+            history.append(message)
+        enforce_memory_budget()
+        history.new_message.notify_all()
+
+def messages_after(group, since, limit):
+    """Returns up to `limit` messages with an id greater than `since` (none if the group has been unloaded)."""
+    with store_lock:
+        history = messages.get(group)
+        return history.after(since, limit) if history else []
+
+def format_sse(batch):
+    """Encodes a batch of messages as one Server-Sent Events message."""
+    with metrics.timed('serialize_sse'):
+        return f"id: {batch[-1].id}\ndata: {json.dumps([message.to_dict() for message in batch])}\n\n"
+
+def wait_for_messages(group, since, timeout, presence_version=None):
+    """Blocks until the group has a message newer than `since` or `timeout` seconds pass.
+
+    With `presence_version`, also returns as soon as the group's presence moves past it. Returns
+    early, too, if the group is deleted or changed (its sessions may have ended).
+    """
+    with store_lock:
+        history = messages.get(group)
+        if history is None:
+            return
+        entry = groups.get(group)
+        history.new_message.wait_for(lambda: history.last_id > since or groups.get(group) is not entry or (
+            presence_version is not None and presence_tracker.version(group) != presence_version), timeout)
+
+# Presence: clients say who they are (`username`) on polls, streams and the WebSocket, and are
+# shown as online until PRESENCE_TTL seconds after the last of those. Open streams refresh it
+# every STREAM_KEEPALIVE. Typing shows for TYPING_TTL seconds unless repeated.
+# Each worker process only knows about its own clients.
+PRESENCE_TTL = int(os.environ.get('CHAT_PRESENCE_TTL', 40))
+TYPING_TTL = 6
+presence_tracker = presence.Presence(PRESENCE_TTL, TYPING_TTL)
+# Callables run as listener(group) when a group's presence summary changes, with store_lock held
+presence_listeners = []
+
+def update_presence(group, username=None, typing=None):
+    """Records that `username` is in `group` (see Presence.seen), expires stale entries everywhere,
+    and wakes the streams and long-polls of any group whose summary changed."""
+    with store_lock:
+        changed = presence_tracker.expire()
+        if username is not None and presence_tracker.seen(group, username, typing):
+            changed.add(group)
+        for name in changed:
+            if name in messages:
+                messages[name].new_message.notify_all()
+            for listener in presence_listeners:
+                listener(name)
+
+def presence_summary(group):
+    """The group's (presence version, summary)."""
+    with store_lock:
+        return presence_tracker.version(group), presence_tracker.summary(group)
+
+def format_presence_sse(summary):
+    return f"event: presence\ndata: {json.dumps(summary)}\n\n"
+
+# Message pages as rows of MESSAGE_FIELDS instead of objects, for clients that ask for this type in
+# Accept (the bundled page does). Saves repeating every key in every message.
+COMPACT_MIMETYPE = 'application/vnd.chat.compact+json'
+MESSAGE_FIELDS = ('id', 'username', 'text', 'timestamp', 'full')
+# Smaller responses are sent uncompressed: the saving doesn't pay for the work
+COMPRESS_MIN_BYTES = int(os.environ.get('CHAT_COMPRESS_MIN_BYTES', 1024))
+
+def compress(body, encoding):
+    """`body` compressed with 'br' or 'gzip', at levels cheap enough to do per response."""
+    with metrics.timed(f'compress_{encoding}'):
+        if encoding == 'br':
+            return brotli.compress(body, quality=5)
+        return gzip.compress(body, compresslevel=6)
+
+def accepted_encoding():
+    """The compression the client prefers ('br' or 'gzip'), or None."""
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+# Encoded GET /messages bodies, keyed by (group, version, presence version, since, before, limit, compact).
+# A group's version changes whenever its history does, so unchanged polls are served from here without
+# re-serializing. Old versions simply age out of the LRU.
+RESPONSE_CACHE_SIZE = int(os.environ.get('CHAT_RESPONSE_CACHE_SIZE', 1024))
+response_cache = OrderedDict()
+
+class CachedBody:
+    """An encoded JSON response body, its ETag, and compressed variants made on first request.
+
+    Message pages also keep their `cursor`, so WebSocket pushes can reuse them (see asgi.py).
+    """
+
+    def __init__(self, body, cursor=None):
+        self.body = body
+        self.cursor = cursor
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.variants = {}
+
+    def encoded(self, encoding):
+        if encoding not in self.variants:
+            self.variants[encoding] = compress(self.body, encoding)
+        return self.variants[encoding]
+
+def cached_messages_body(group, limit, since=None, before=None, compact=False):
+    """Returns the CachedBody for a GET /messages page, encoding it only on a cache miss.
+
+    The page holds the messages after `since`, else the ones just before `before`, else the
+    latest `limit` messages. `cursor`/`more` continue forward from it, `before`/`older` back.
+    It also carries the group's presence summary. `compact` pages list the messages as rows of
+    `fields` (see COMPACT_MIMETYPE).
+    """
+    with store_lock:
+        history = messages[group]
+        key = (group, history.version, presence_tracker.version(group), since, before, limit, compact)
+        entry = response_cache.get(key)
+        if entry:
+            response_cache.move_to_end(key)
+            return entry
+        if since is not None:
+            batch = history.after(since, limit)
+        else:
+            batch = history.before(history.last_id + 1 if before is None else before, limit)
+        last_id = history.last_id
+        first_id = history.first_id()
+        who = presence_tracker.summary(group)
+
+    if batch:
+        cursor = batch[-1].id
+    elif since is not None:
+        cursor = max(since, 0)
+    else:
+        cursor = last_id if before is None else min(before - 1, last_id)
+    oldest = batch[0].id if batch else cursor + 1
+    with metrics.timed('serialize_messages'):
+        page = {
+            'messages': [message.to_row() if compact else message.to_dict() for message in batch],
+            'cursor': cursor,
+            'more': cursor < last_id,
+            'before': oldest,
+            'older': oldest > first_id,
+            'presence': who
         }
-    ]
+        if compact:
+            page['fields'] = MESSAGE_FIELDS
+        entry = CachedBody(json.dumps(page, separators=(',', ':')).encode(), cursor)
+
+    with store_lock:
+        response_cache[key] = entry
+        while len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+    return entry
+
+def cached_response(entry, mimetype='application/json', cache_control='no-cache', vary='Accept-Encoding'):
+    """Sends a CachedBody, answering If-None-Match with 304 and using a compressed variant if accepted.
+
+    Each variant is compressed once per body, however many clients fetch it.
+    """
+    headers = {
+        'ETag': f'"{entry.etag}"',
+        'Cache-Control': cache_control,
+        'Vary': vary
+    }
+    if entry.etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+
+    encoding = accepted_encoding() if len(entry.body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        return Response(entry.encoded(encoding), mimetype=mimetype, headers=headers)
+    return Response(entry.body, mimetype=mimetype, headers=headers)
+
+# Uploaded images, stored once as raw bytes keyed by their SHA-256 hash (hash -> (mime type, bytes)).
+# Messages only carry a short /media/<hash> reference, so identical uploads share one copy.
+# Kept in upload order so the memory budget can drop the oldest media first.
+media = OrderedDict()
+
+def store_media(data, mime_type):
+    """Stores a blob under its SHA-256 hash (de-duplicating repeats) and returns the hash."""
+    digest = hashlib.sha256(data).hexdigest()
+    broker.publish_media(digest, mime_type, data)
+    return digest
+
+def keep_media(digest, mime_type, data):
+    """Adds a blob to this process's media store (and to disk, if persistence is on)."""
+    if DATA_DIR:
+        save_media_to_disk(digest, mime_type, data)
+    with store_lock:
+        if digest in media:
+            # Re-uploaded media counts as new again
+            media.move_to_end(digest)
+        else:
+            media[digest] = (mime_type, data)
+            stats['media_bytes'] += len(data)
+            enforce_memory_budget()
+
+def held_bytes():
+    """Bytes currently held by all histories and media. Caller must hold store_lock."""
+    return stats['media_bytes'] + sum(history.bytes for history in messages.values())
+
+def enforce_memory_budget():
+    """Evicts the oldest media, then the oldest messages of the largest group, until under budget.
+
+    Caller must hold store_lock.
+    """
+    total = held_bytes()
+    while total > MEMORY_BUDGET_BYTES and media:
+        _, (_, data) = media.popitem(last=False)
+        stats['media_bytes'] -= len(data)
+        stats['evicted_media'] += 1
+        total -= len(data)
+    while total > MEMORY_BUDGET_BYTES:
+        largest = max(messages.values(), key=lambda history: history.bytes)
+        if largest.count <= 1:
+            break
+        before = largest.bytes
+        largest.evict_oldest()
+        total -= before - largest.bytes
+
+# Optional durable storage. When CHAT_DATA_DIR is set, every group gets an append-only log
+# and uploaded media are written to disk, so history survives restarts and deploys.
+DATA_DIR = os.environ.get('CHAT_DATA_DIR')
+# Appends are fsynced together every FSYNC_INTERVAL seconds (group commit); a POST returns
+# once its record is on disk. Every SNAPSHOT_EVERY records the in-memory tail is snapshotted
+# so startup only replays the log written after the last snapshot.
+FSYNC_INTERVAL = float(os.environ.get('CHAT_FSYNC_INTERVAL', 0.005))
+SNAPSHOT_EVERY = int(os.environ.get('CHAT_SNAPSHOT_EVERY', 1000))
+
+# Log records (and media files) are a 4-byte big-endian length followed by the payload.
+RECORD_HEADER = struct.Struct('>I')
+
+def snapshot_of(history):
+    """The history's (last id, messages), for a snapshot file. Caller must hold store_lock.
+
+    Cheap (messages never change, so they're shared rather than copied): encode it with
+    snapshot_json once the lock is released.
+    """
+    return history.last_id, history.after(0, history.count)
+
+def snapshot_json(snapshot, **fields):
+    last_id, batch = snapshot
+    return json.dumps(dict(fields, last_id=last_id, messages=[message.record() for message in batch])).encode()
+
+def restore_snapshot(history, snapshot):
+    for record in snapshot['messages']:
+        history.last_id = record['id']
+        history.append(Message.from_record(record))
+    history.last_id = snapshot['last_id']
+
+class LogSyncFailed(BrokerUnavailable):
+    """Raised to posts whose log sync failed: they're in the history but may not be on disk."""
+
+class MessageLog:
+    """Append-only, length-prefixed log of one group's messages plus a snapshot of its tail.
+
+    Opening the log recovers the group: the snapshot is loaded into `history` and only
+    the records after the snapshot's offset are replayed. A torn record left by a crash
+    is truncated away.
+    """
+
+    def __init__(self, directory, history):
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, 'messages.log')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.records_since_snapshot = self.recover(history)
+        self.file = open(self.log_path, 'ab')
+        self.written = self.file.tell()
+        self.synced = self.written
+        # Offset of the last sync that failed; posts waiting on it are failed, not left hanging
+        self.failed = 0
+        self.synced_changed = threading.Condition()
+        # Keeps a sync from running into close()
+        self.sync_lock = threading.Lock()
+
+    def recover(self, history):
+        """Rebuilds `history` from disk and returns the number of records replayed."""
+        offset = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            offset = snapshot['offset']
+            restore_snapshot(history, snapshot)
+
+        replayed = 0
+        if not os.path.exists(self.log_path):
+            return replayed
+        with open(self.log_path, 'r+b') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (length,) = RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                message = Message.from_record(json.loads(data))
+                history.last_id = message.id
+                history.append(message)
+                offset += RECORD_HEADER.size + length
+                replayed += 1
+            # Drop a partially written record from a crash mid-append
+            f.truncate(offset)
+        return replayed
+
+    def write(self, batch):
+        """Appends one record per message and returns the log offset to wait for. Caller must hold store_lock."""
+        records = []
+        for message in batch:
+            data = json.dumps(message.record(), separators=(',', ':')).encode()
+            records.append(RECORD_HEADER.pack(len(data)) + data)
+        records = b''.join(records)
+        self.file.write(records)
+        self.written += len(records)
+        self.records_since_snapshot += len(batch)
+        return self.written
+
+    def wait_synced(self, offset):
+        """Blocks until everything up to `offset` has been fsynced. Raises LogSyncFailed if that sync failed."""
+        with self.synced_changed:
+            self.synced_changed.wait_for(lambda: self.synced >= offset or self.failed >= offset)
+            if self.synced < offset:
+                raise LogSyncFailed('could not write the message log')
+
+    def sync(self, history, snapshot=False):
+        """Fsyncs all pending appends at once, then snapshots the tail if it's due (or `snapshot` is set)."""
+        with self.sync_lock:
+            if self.file.closed:
+                return
+            with store_lock:
+                snapshot = self.records_since_snapshot > 0 and (snapshot or self.records_since_snapshot >= SNAPSHOT_EVERY)
+                if self.written == self.synced and not snapshot:
+                    return
+                offset = self.written
+                if snapshot:
+                    snapshot = snapshot_of(history)
+                    self.records_since_snapshot = 0
+            # The file's own lock keeps this in order with appends made meanwhile, so store_lock
+            # (and every reader waiting on it) isn't held for the write-out
+            try:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except Exception:
+                self.fail(offset)
+                raise
+            with self.synced_changed:
+                self.synced = offset
+                self.synced_changed.notify_all()
+            # Written after the fsync, so a snapshot never points past what's durable
+            if snapshot:
+                write_file_atomically(self.snapshot_path, snapshot_json(snapshot, offset=offset))
+
+    def fail(self, offset):
+        """Fails the posts waiting for `offset`. Later syncs still try to write everything out."""
+        with self.synced_changed:
+            self.failed = offset
+            self.synced_changed.notify_all()
+
+    def close(self, history):
+        """Syncs and snapshots the tail (so reopening replays nothing), then closes the log."""
+        self.sync(history, snapshot=True)
+        with self.sync_lock:
+            self.file.close()
+
+def write_file_atomically(path, data):
+    """Writes a file via a temporary file and rename, so readers never see a half-written file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def sync_logs_forever():
+    """Background group-commit loop shared by all groups' logs."""
+    failing = set()
+    while True:
+        time.sleep(FSYNC_INTERVAL)
+        for group, log in list(message_logs.items()):
+            history = messages.get(group)
+            if history is None:
+                continue
+            try:
+                log.sync(history)
+            except Exception as e:
+                # A full or failing disk fails this group's posts (see wait_synced), not the loop
+                metrics.inc('chat_log_sync_errors_total', 'Failed message log syncs', group=group)
+                if group not in failing:
+                    print(f'error: could not sync the message log of {group}: {e!r}', file=sys.stderr)
+                    failing.add(group)
+            else:
+                failing.discard(group)
+
+def media_path(digest):
+    return os.path.join(DATA_DIR, 'media', digest)
+
+def save_media_to_disk(digest, mime_type, data):
+    if os.path.exists(media_path(digest)):
+        return
+    os.makedirs(os.path.dirname(media_path(digest)), exist_ok=True)
+    mime = mime_type.encode()
+    write_file_atomically(media_path(digest), RECORD_HEADER.pack(len(mime)) + mime + data)
+
+def load_media_from_disk(digest):
+    """Returns (mime type, bytes) for a persisted blob, or None."""
+    if not DATA_DIR or not re.fullmatch(r'[0-9a-f]{64}', digest) or not os.path.exists(media_path(digest)):
+        return None
+    with open(media_path(digest), 'rb') as f:
+        (length,) = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        mime_type = f.read(length).decode()
+        return mime_type, f.read()
+
+# group -> MessageLog, only populated when DATA_DIR is set and this process owns the history.
+message_logs = {}
+
+# Group registry: name -> {'password_hash', 'session_key'}. Every process knows every group (an
+# entry is small), but a group's history is only loaded when it's used (see open_group) and is
+# hibernated again after GROUP_IDLE_SECONDS without use, so thousands of quiet groups cost
+# little memory. The process that owns the histories saves the registry to DATA_DIR/groups.json.
+groups = {}
+# Bumped whenever a group is created, changed or deleted
+groups_version = 0
+# Callables run as listener(name, entry) when a group is created or changed, or deleted (entry
+# None), while store_lock is held. Used to wake asyncio streams and feed broker.py.
+group_listeners = []
+# Group names are used in paths under DATA_DIR, so they're limited to a safe alphabet
+GROUP_NAME_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+# Never less than a long-poll or stream keepalive, so nobody's waiting on a group when it goes
+GROUP_IDLE_SECONDS = max(int(os.environ.get('CHAT_GROUP_IDLE_SECONDS', 600)), 2 * MAX_LONG_POLL_WAIT)
+loading = {}  # group -> Event set when its load (or hibernation) finishes
+registry_write_lock = threading.Lock()
+
+def group_dir(name):
+    if not GROUP_NAME_RE.fullmatch(name):
+        raise ValueError(f'invalid group name {name!r}')
+    return os.path.join(DATA_DIR, 'groups', name)
+
+def registry_path():
+    return os.path.join(DATA_DIR, 'groups.json')
+
+def load_registry():
+    """The saved group registry, or DEFAULT_GROUPS if nothing has been saved yet."""
+    if DATA_DIR and os.path.exists(registry_path()):
+        with open(registry_path()) as f:
+            return {name: entry for name, entry in json.load(f).items() if GROUP_NAME_RE.fullmatch(name)}
+    # An empty session key matches sessions issued before keys existed
+    return {name: {'password_hash': hashed, 'session_key': ''} for name, hashed in DEFAULT_GROUPS.items()}
+
+def save_registry():
+    if not DATA_DIR:
+        return
+    with registry_write_lock:
+        with store_lock:
+            data = json.dumps(groups, indent=1).encode()
+        os.makedirs(DATA_DIR, exist_ok=True)
+        write_file_atomically(registry_path(), data)
+
+def apply_group(name, entry):
+    """Creates or changes (`entry`) or deletes (None) a group in this process. Deleting drops its history."""
+    global groups_version
+    log = None
+    with store_lock:
+        if entry is None:
+            groups.pop(name, None)
+            ingest_queues.pop(name, None)
+            history = messages.pop(name, None)
+            log = message_logs.pop(name, None)
+            if history is not None:
+                history.new_message.notify_all()
+        else:
+            groups[name] = entry
+            # Streams wake up to check their sessions against the new entry
+            if name in messages:
+                messages[name].new_message.notify_all()
+        groups_version += 1
+        for listener in group_listeners:
+            listener(name, entry)
+    if log:
+        log.close(history)
+
+def apply_registry(registry, snapshots):
+    """Replaces this process's groups and loaded histories with the broker's (when connecting to it)."""
+    global groups_version
+    with store_lock:
+        groups.clear()
+        groups.update(registry)
+        groups_version += 1
+        # Groups the broker doesn't have loaded may have moved on; they're fetched again when used
+        for group in [group for group in messages if group not in snapshots and group not in loading]:
+            del messages[group]
+    for group, snapshot in snapshots.items():
+        apply_snapshot(group, snapshot)
+
+def touch_group(group):
+    """Marks a loaded group as just used. Returns False if it isn't loaded (hibernated or deleted)."""
+    with store_lock:
+        history = messages.get(group)
+        if history is None or group in loading:
+            return False
+        history.touched = time.monotonic()
+        messages.move_to_end(group)
+        return True
+
+def open_group(group):
+    """Loads `group` if it isn't (waking it from hibernation) and marks it as used.
+
+    Returns False if there's no such group. Concurrent callers share one load, and a group that's
+    being hibernated is only loaded again once it's been put away.
+    """
+    while True:
+        with store_lock:
+            history = messages.get(group)
+            if history is not None and group not in loading:
+                history.touched = time.monotonic()
+                messages.move_to_end(group)
+                return True
+            if group not in groups:
+                return False
+            event = loading.get(group)
+            if event is None:
+                event = loading[group] = threading.Event()
+                ingest_queues.setdefault(group, IngestQueue(group))
+                break
+        # Someone else is loading or hibernating it: wait for them, then look again
+        event.wait()
+    try:
+        with metrics.timed('group_load'):
+            broker.load(group)
+    finally:
+        with store_lock:
+            del loading[group]
+        event.set()
+    return touch_group(group)
+
+def hibernate_idle_groups():
+    """Unloads the groups nobody has used for GROUP_IDLE_SECONDS, least recently used first."""
+    idle_since = time.monotonic() - GROUP_IDLE_SECONDS
+    while True:
+        with store_lock:
+            if not messages:
+                return
+            group, history = next(iter(messages.items()))
+            if history.touched > idle_since or group in loading:
+                return
+            del messages[group]
+            # Until it's on disk, open_group waits instead of starting the group afresh
+            event = loading[group] = threading.Event()
+        try:
+            broker.unload(group, history)
+        except Exception as e:
+            # It's still all here: keep it loaded (unless it's been deleted) and try again later
+            print(f'error: could not hibernate {group}: {e!r}', file=sys.stderr)
+            metrics.inc('chat_hibernate_errors_total', 'Idle groups that could not be unloaded')
+            with store_lock:
+                if group in groups:
+                    history.touched = time.monotonic()
+                    messages[group] = history
+            continue
+        finally:
+            with store_lock:
+                del loading[group]
+            event.set()
+        metrics.inc('chat_groups_hibernated_total', 'Idle groups unloaded from memory')
+
+def hibernate_forever():
+    while True:
+        time.sleep(GROUP_IDLE_SECONDS / 10)
+        hibernate_idle_groups()
+
+# Without CHAT_DATA_DIR, hibernated groups are parked in files here until they're used again.
+spill_dir = None
+
+def spill_path(group):
+    return os.path.join(spill_dir, group + '.json')
+
+def spill_group(group, history):
+    global spill_dir
+    if spill_dir is None:
+        spill_dir = tempfile.mkdtemp(prefix='chat-hibernated-')
+    with store_lock:
+        snapshot = snapshot_of(history)
+    write_file_atomically(spill_path(group), snapshot_json(snapshot))
+
+def unspill_group(group, history):
+    """Restores a spilled group into `history` and deletes its file. Returns False if it wasn't spilled."""
+    if spill_dir is None or not os.path.exists(spill_path(group)):
+        return False
+    with open(spill_path(group)) as f:
+        restore_snapshot(history, json.load(f))
+    os.remove(spill_path(group))
+    return True
+
+class LocalBroker(Broker):
+    """Single-process broker: this process sequences, stores and persists its own messages."""
+
+    def start(self):
+        groups.update(load_registry())
+        # Saves the defaults on first start
+        save_registry()
+        if DATA_DIR:
+            threading.Thread(target=sync_logs_forever, name='log-sync', daemon=True).start()
+
+    def load(self, group):
+        # Read into a history nobody else can see yet, then swap it in
+        history = MessageHistory(MAX_MESSAGES_PER_GROUP, MAX_BYTES_PER_GROUP)
+        log = MessageLog(group_dir(group), history) if DATA_DIR else None
+        if not log:
+            unspill_group(group, history)
+        with store_lock:
+            deleted = group not in groups
+            if not deleted:
+                # Replaying may have trimmed the history to the limits; that isn't a runtime eviction
+                stats['evicted_messages'] -= history.evicted
+                history.evicted = 0
+                messages[group] = history
+                if log:
+                    message_logs[group] = log
+                enforce_memory_budget()
+        if deleted:
+            # Deleted while it was being read (update_group removes the files once we're done)
+            if log:
+                log.file.close()
+            return
+        # A new group starts with a welcome message
+        if history.last_id == 0:
+            store_messages(group, [('ChatBot', f'Welcome to the {group} group! Say hi 👋', None)])
+
+    def unload(self, group, history):
+        with store_lock:
+            log = message_logs.pop(group, None)
+        if not log:
+            spill_group(group, history)
+            return
+        try:
+            log.close(history)
+        except Exception:
+            # Stays open for hibernate_idle_groups to put the group back
+            with store_lock:
+                deleted = group not in groups
+                if not deleted:
+                    message_logs[group] = log
+            if deleted:
+                log.file.close()
+            raise
+
+    def update_group(self, name, entry):
+        apply_group(name, entry)
+        save_registry()
+        if entry is None:
+            # Deleted for good, history included, once a load or hibernation in progress is done
+            # with its files. It's out of the registry, so no new one can start.
+            with store_lock:
+                event = loading.get(name)
+            if event:
+                event.wait()
+            if DATA_DIR:
+                shutil.rmtree(group_dir(name), ignore_errors=True)
+            if spill_dir is not None and os.path.exists(spill_path(name)):
+                os.remove(spill_path(name))
+
+    def publish(self, group, entries):
+        return store_messages(group, entries)
+
+    def publish_media(self, digest, mime_type, data):
+        keep_media(digest, mime_type, data)
 
-# The HTML template for the chat frontend.
+# With CHAT_BROKER set ('host:port' or 'unix:/path' of a `python broker.py` hub), several
+# worker processes share one chat: the hub sequences and stores messages, workers mirror them.
+BROKER_ADDRESS = os.environ.get('CHAT_BROKER')
+
+broker = SocketBroker(BROKER_ADDRESS, sys.modules[__name__]) if BROKER_ADDRESS else LocalBroker()
+broker.start()
+threading.Thread(target=hibernate_forever, name='hibernate', daemon=True).start()
+
+# Uploads bigger than this are refused with 413 before the body is read.
+MAX_UPLOAD_BYTES = int(os.environ.get('CHAT_MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+# Decoding, resizing and re-encoding uploads (see images.py) happens in worker processes.
+IMAGE_WORKERS = int(os.environ.get('CHAT_IMAGE_WORKERS', 2))
+IMAGE_TIMEOUT = 30
+image_pool_lock = threading.Lock()
+
+def new_image_pool():
+    return ProcessPoolExecutor(
+        max_workers=IMAGE_WORKERS,
+        # Forked workers don't re-run this module; they only ever call into images.py
+        mp_context=multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    )
+
+image_pool = new_image_pool()
+
+def replace_image_pool(broken):
+    """Swaps a fresh pool in for `broken`, which refuses all work once one of its processes has died."""
+    global image_pool
+    with image_pool_lock:
+        if image_pool is broken:
+            image_pool = new_image_pool()
+        pool = image_pool
+    broken.shutdown(wait=False)
+    return pool
+
+def process_upload(data, mime_type):
+    """Runs images.process_image in the pool. Raises BrokenProcessPool if its process dies on the way."""
+    pool = image_pool
+    try:
+        future = pool.submit(images.process_image, data, mime_type)
+    except BrokenProcessPool:
+        # Broken by an earlier upload (or the OOM killer), not by this one
+        pool = replace_image_pool(pool)
+        future = pool.submit(images.process_image, data, mime_type)
+    try:
+        return future.result(timeout=IMAGE_TIMEOUT)
+    except BrokenProcessPool:
+        replace_image_pool(pool)
+        raise
+
+# Joining a group costs one bcrypt check (~250 ms of CPU at cost 12). A successful join
+# returns a signed, expiring session token that every later call presents instead.
+app.secret_key = os.environ.get('CHAT_SECRET_KEY') or secrets.token_hex(32)
+SESSION_MAX_AGE = int(os.environ.get('CHAT_SESSION_MAX_AGE', 12 * 60 * 60))
+session_tokens = URLSafeTimedSerializer(app.secret_key, salt='group-session')
+
+# bcrypt runs on a small pool so join storms can't take every CPU away from message
+# traffic; once BCRYPT_MAX_PENDING checks are queued, further joins are turned away.
+BCRYPT_WORKERS = int(os.environ.get('CHAT_BCRYPT_WORKERS', 2))
+BCRYPT_MAX_PENDING = int(os.environ.get('CHAT_BCRYPT_MAX_PENDING', 16))
+bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix='bcrypt')
+bcrypt_slots = threading.BoundedSemaphore(BCRYPT_MAX_PENDING)
+bcrypt_pending = metrics.Tracker('chat_bcrypt_pending', 'bcrypt checks running or queued')
+
+# Per-IP token bucket for /check_group: JOIN_BURST attempts at once, refilling at
+# JOIN_ATTEMPTS_PER_MINUTE.
+JOIN_ATTEMPTS_PER_MINUTE = int(os.environ.get('CHAT_JOIN_ATTEMPTS_PER_MINUTE', 10))
+JOIN_BURST = int(os.environ.get('CHAT_JOIN_BURST', 5))
+join_buckets = {}  # ip -> (tokens, last refill time)
+join_buckets_lock = threading.Lock()
+
+def allow_join_attempt(ip):
+    """Takes a token from the IP's bucket; returns False when it's empty."""
+    now = time.monotonic()
+    rate = JOIN_ATTEMPTS_PER_MINUTE / 60
+    with join_buckets_lock:
+        if len(join_buckets) > 10000:
+            # Forget IPs whose buckets have refilled completely
+            for stale_ip, (_, last) in list(join_buckets.items()):
+                if (now - last) * rate >= JOIN_BURST:
+                    del join_buckets[stale_ip]
+        tokens, last = join_buckets.get(ip, (JOIN_BURST, now))
+        tokens = min(JOIN_BURST, tokens + (now - last) * rate)
+        if tokens < 1:
+            join_buckets[ip] = (tokens, now)
+            return False
+        join_buckets[ip] = (tokens - 1, now)
+        return True
+
+def check_password(password, hashed):
+    """Runs bcrypt on the pool. Returns None if too many checks are already queued."""
+    if not bcrypt_slots.acquire(blocking=False):
+        return None
+    try:
+        with metrics.timed('bcrypt_verify'), bcrypt_pending.tracking():
+            return bcrypt_pool.submit(bcrypt.checkpw, password.encode(), hashed.encode()).result()
+    finally:
+        bcrypt_slots.release()
+
+def read_session(token):
+    """Returns a valid session token's (group, session key, expiry time), or None if it's invalid, expired or void."""
+    try:
+        session, issued = session_tokens.loads(token, max_age=SESSION_MAX_AGE, return_timestamp=True)
+    except BadSignature:
+        return None
+    session = (session.get('group'), session.get('key', ''), issued.timestamp() + SESSION_MAX_AGE)
+    return session if session_current(session) else None
+
+def session_current(session):
+    """True while a session is good: not expired, and its group hasn't been deleted or given a new password.
+
+    Streams and sockets check this as they go, since they outlive the check made when they opened.
+    """
+    group, key, expires = session
+    entry = groups.get(group)
+    # Sessions issued before the group's password changed (or before it was deleted) are void
+    return entry is not None and key == entry['session_key'] and time.time() < expires
+
+def session_group(token):
+    """Returns the group a session token was issued for, or None if it's invalid or expired."""
+    session = read_session(token)
+    return session[0] if session else None
+
+def request_session():
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    # EventSource and plain form posts can't set headers, so they pass the token as a field
+    return read_session(token or request.values.get('token', ''))
+
+def session_error(group):
+    """Returns an error response unless the request carries a valid session token for `group`.
+
+    The group is loaded (see open_group) once the session checks out.
+    """
+    session = request_session()
+    session_group_name = session[0] if session else None
+    if session_group_name is None:
+        return jsonify({'status': 'error', 'message': 'Missing or expired session, join the group again'}), 401
+    if session_group_name != group:
+        return jsonify({'status': 'error', 'message': 'Session is not valid for this group'}), 403
+    if not open_group(group):
+        return jsonify({'status': 'error', 'message': 'Invalid group'}), 400
+    return None
+
+# The /admin API is off unless CHAT_ADMIN_TOKEN is set; requests send it as a Bearer token.
+ADMIN_TOKEN = os.environ.get('CHAT_ADMIN_TOKEN')
+
+def admin_error():
+    """Returns an error response unless the request carries the admin token."""
+    if not ADMIN_TOKEN:
+        return jsonify({'status': 'error', 'message': 'Admin API is disabled'}), 404
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'status': 'error', 'message': 'Invalid admin token'}), 401
+    return None
+
+def password_error(password):
+    # bcrypt only looks at the first 72 bytes
+    if not isinstance(password, str) or not 0 < len(password.encode()) <= 72:
+        return jsonify({'status': 'error', 'message': 'Password must be 1 to 72 bytes'}), 400
+    return None
+
+def new_group_entry(password):
+    """A registry entry for `password`. Its new session key voids the sessions of any previous entry."""
+    with metrics.timed('bcrypt_hash'):
+        hashed = bcrypt_pool.submit(bcrypt.hashpw, password.encode(), bcrypt.gensalt()).result().decode()
+    return {'password_hash': hashed, 'session_key': secrets.token_hex(8)}
+
+# Metrics served at /metrics (see metrics.py). Set CHAT_PROFILE_DIR to also cProfile a sample
+# of requests (CHAT_PROFILE_SAMPLE_RATE) and keep the profiles of those slower than
+# CHAT_PROFILE_SLOW_MS there, for `python -m pstats` or snakeviz.
+PROFILE_DIR = os.environ.get('CHAT_PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.environ.get('CHAT_PROFILE_SAMPLE_RATE', 0.1))
+PROFILE_SLOW_MS = float(os.environ.get('CHAT_PROFILE_SLOW_MS', 250))
+if PROFILE_DIR:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+pollers = metrics.Tracker('chat_connected_pollers', 'Open /stream connections and waiting long-polls')
+
+def group_gauge(field):
+    def read():
+        with store_lock:
+            return {(('group', name),): getattr(history, field) for name, history in messages.items()}
+    return read
+
+metrics.gauge('chat_group_messages', 'Messages held per group', group_gauge('count'))
+metrics.gauge('chat_group_bytes', 'Approximate bytes held per group', group_gauge('bytes'))
+metrics.gauge('chat_groups', 'Groups, loaded in memory or not', lambda: {
+    (('state', 'loaded'),): len(messages), (('state', 'hibernated'),): len(groups) - len(messages)})
+metrics.gauge('chat_media_bytes', 'Bytes of media held in memory', lambda: {(): stats['media_bytes']})
+metrics.gauge('chat_media_count', 'Media blobs held in memory', lambda: {(): len(media)})
+metrics.gauge('chat_evicted', 'Messages and media evicted to stay within the memory limits',
+              lambda: {(('kind', 'messages'),): stats['evicted_messages'], (('kind', 'media'),): stats['evicted_media']})
+
+# Frontend files from static/, served under URLs with a hash of their content in them
+# (/static/chat.<hash>.js) so browsers can keep them forever. Compressed once at startup.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+static_assets = {}  # fingerprinted name -> (mime type, CachedBody)
+asset_urls = {}     # file name -> fingerprinted URL, for the page template
+
+def load_static_assets():
+    for name in sorted(os.listdir(STATIC_DIR)):
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            entry = CachedBody(f.read())
+        # Highest compression levels: this only runs once per start
+        entry.variants['gzip'] = gzip.compress(entry.body, compresslevel=9)
+        if brotli:
+            entry.variants['br'] = brotli.compress(entry.body, quality=11)
+        stem, extension = os.path.splitext(name)
+        fingerprinted = f'{stem}.{entry.etag[:16]}{extension}'
+        static_assets[fingerprinted] = (mimetypes.guess_type(name)[0] or 'application/octet-stream', entry)
+        asset_urls[name] = f'/static/{fingerprinted}'
+
+load_static_assets()
+
+# The HTML template for the chat frontend. Compiled once; the rendered page is cached
+# until the group list changes.
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -40,22 +1307,9 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>bhook++</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap" rel="stylesheet">
-    <script type="module" src="https://cdn.jsdelivr.net/npm/emoji-picker-element@^1/index.js"></script>
-    <style>
-        body { font-family: 'Inter', sans-serif; }
-        #messages { scroll-behavior: smooth; }
-        .gif-item { cursor: pointer; transition: transform 0.2s; }
-        .gif-item:hover { transform: scale(1.05); }
-        /* Hide scrollbar for the GIF results */
-        #gif-results::-webkit-scrollbar { display: none; }
-        #gif-results { -ms-overflow-style: none; scrollbar-width: none; }
-    </style>
+    <link rel="stylesheet" href="{{ assets['chat.css'] }}">
 </head>
-<body class="bg-gray-100 dark:bg-gray-900 text-gray-900 dark:text-gray-100">
+<body class="bg-gray-100 dark:bg-gray-900 text-gray-900 dark:text-gray-100" data-groups='{{ groups | tojson }}'>
 
     <div id="login-screen" class="flex items-center justify-center h-screen">
         <div class="bg-white dark:bg-gray-800 p-8 rounded-lg shadow-md w-full max-w-sm">
@@ -97,6 +1351,7 @@ HTML_TEMPLATE = """
             <h1 class="text-3xl font-bold text-blue-600 dark:text-blue-400">Local Network Chat</h1>
             <p id="welcome-message" class="text-sm text-gray-500 dark:text-gray-400">Welcome, ...</p>
             <p id="current-group" class="text-xs text-gray-400 dark:text-gray-500">Group: ...</p>
+            <p id="presence" class="text-xs text-gray-400 dark:text-gray-500"></p>
             <button id="leave-group-btn" class="absolute top-0 right-0 mt-2 bg-red-500 hover:bg-red-600 text-white font-bold py-2 px-4 rounded-lg transition text-sm">
                 Change Group
             </button>
@@ -124,9 +1379,7 @@ HTML_TEMPLATE = """
                 <img id="image-preview" class="max-h-20 rounded" src="">
                 <button id="cancel-image" class="text-red-500 hover:text-red-700 font-bold">&times;</button>
             </div>
-            <div id="emoji-picker-container" class="absolute bottom-16 right-0 z-10 hidden">
-                <emoji-picker class="dark"></emoji-picker>
-            </div>
+            <div id="emoji-picker-container" class="absolute bottom-16 right-0 z-10 hidden"></div>
         </div>
     </div>
 
@@ -140,394 +1393,373 @@ HTML_TEMPLATE = """
         </div>
     </div>
 
-    <script>
-        // --- Tenor API Configuration ---
-        const TENOR_API_KEY = ""; 
-        const TENOR_CLIENT_KEY = "my-local-chat-app"; 
-
-        // Injected group list from server
-        const GROUPS = {{ groups | tojson }};
-
-        // DOM Elements
-        const loginScreen = document.getElementById('login-screen');
-        const groupScreen = document.getElementById('group-screen');
-        const chatScreen = document.getElementById('chat-screen');
-
-        const loginForm = document.getElementById('login-form');
-        const usernameInput = document.getElementById('username-input');
-        const welcomeMessage = document.getElementById('welcome-message');
-        const currentGroupLabel = document.getElementById('current-group');
-
-        const groupForm = document.getElementById('group-form');
-        const groupSelect = document.getElementById('group-select');
-        const groupPassInput = document.getElementById('group-pass-input');
-        const cancelToLogin = document.getElementById('cancel-to-login');
-        const leaveGroupBtn = document.getElementById('leave-group-btn');
-
-        const messagesContainer = document.getElementById('messages');
-        const messageForm = document.getElementById('message-form');
-        const messageInput = document.getElementById('message-input');
-
-        const emojiBtn = document.getElementById('emoji-btn');
-        const emojiPickerContainer = document.getElementById('emoji-picker-container');
-        const emojiPicker = document.querySelector('emoji-picker');
-
-        const gifBtn = document.getElementById('gif-btn');
-        const gifModal = document.getElementById('gif-modal');
-        const gifModalClose = document.getElementById('gif-modal-close');
-        const gifSearchInput = document.getElementById('gif-search-input');
-        const gifResults = document.getElementById('gif-results');
-        
-        // --- NEW: Image upload elements ---
-        const imageUpload = document.getElementById('image-upload');
-        const imagePreviewContainer = document.getElementById('image-preview-container');
-        const imagePreview = document.getElementById('image-preview');
-        const cancelImage = document.getElementById('cancel-image');
-        let selectedFile = null;
-
-        let username = '';
-        let currentGroup = '';
-
-        function populateGroups() {
-            groupSelect.innerHTML = '';
-            Object.keys(GROUPS).forEach(g => {
-                const opt = document.createElement('option');
-                opt.value = g;
-                opt.textContent = g;
-                groupSelect.appendChild(opt);
-            });
-        }
-        populateGroups();
-
-        // --- Event Listeners ---
-        loginForm.addEventListener('submit', (event) => {
-            event.preventDefault();
-            const enteredUsername = usernameInput.value.trim();
-            if (enteredUsername) {
-                username = enteredUsername;
-                welcomeMessage.textContent = `Welcome, ${username}!`;
-                loginScreen.classList.add('hidden');
-                groupScreen.classList.remove('hidden');
-            }
-        });
-
-        cancelToLogin.addEventListener('click', () => {
-            groupScreen.classList.add('hidden');
-            loginScreen.classList.remove('hidden');
-        });
-
-        leaveGroupBtn.addEventListener('click', () => {
-            if (window._chatPoller) clearInterval(window._chatPoller);
-            currentGroup = '';
-            groupPassInput.value = '';
-            chatScreen.classList.add('hidden');
-            chatScreen.classList.remove('flex');
-            groupScreen.classList.remove('hidden');
-        });
-
-        groupForm.addEventListener('submit', async (e) => {
-            e.preventDefault();
-            const selectedGroup = groupSelect.value;
-            const password = groupPassInput.value;
-            if (!selectedGroup) {
-                alert('Please select a group.');
-                return;
-            }
-            try {
-                const res = await fetch(`/check_group?name=${encodeURIComponent(selectedGroup)}&password=${encodeURIComponent(password)}`);
-                if (!res.ok) throw new Error('Invalid group or password');
-                const data = await res.json();
-                if (data.status === 'success') {
-                    currentGroup = selectedGroup;
-                    currentGroupLabel.textContent = `Group: ${currentGroup}`;
-                    groupScreen.classList.add('hidden');
-                    chatScreen.classList.remove('hidden');
-                    chatScreen.classList.add('flex');
-                    initializeChat();
-                } else {
-                    alert('Invalid group or password');
-                }
-            } catch (err) {
-                alert('Invalid group or password');
-                console.error('Group join error:', err);
-            }
-        });
-        
-        // --- NEW: Image handling event listeners ---
-        imageUpload.addEventListener('change', (event) => {
-            const file = event.target.files[0];
-            if (file) {
-                selectedFile = file;
-                const reader = new FileReader();
-                reader.onload = (e) => {
-                    imagePreview.src = e.target.result;
-                    imagePreviewContainer.classList.remove('hidden');
-                    messageInput.placeholder = "Image selected. Press send.";
-                    messageInput.disabled = true; 
-                };
-                reader.readAsDataURL(file);
-            }
-        });
-
-        cancelImage.addEventListener('click', () => {
-            selectedFile = null;
-            imageUpload.value = ''; // Clear the file input
-            imagePreviewContainer.classList.add('hidden');
-            messageInput.placeholder = "Type your message...";
-            messageInput.disabled = false;
-        });
-
-
-        // --- Chat Logic ---
-        function initializeChat() {
-            messageForm.onsubmit = handleFormSubmit;
-            emojiBtn.onclick = toggleEmoji;
-            if (emojiPicker) emojiPicker.addEventListener('emoji-click', onEmojiClick);
-            gifBtn.onclick = openGifModal;
-            gifModalClose.onclick = () => gifModal.classList.add('hidden');
-            gifSearchInput.onkeyup = onGifSearchKey;
-            
-            if (window._chatPoller) clearInterval(window._chatPoller);
-            fetchMessages().then(scrollToBottom);
-            window._chatPoller = setInterval(fetchMessages, 2000);
-        }
-
-        function toggleEmoji() {
-            emojiPickerContainer.classList.toggle('hidden');
-        }
+    <script src="{{ assets['chat.js'] }}"></script>
+</body>
+</html>
+"""
 
-        function onEmojiClick(event) {
-            messageInput.value += event.detail.unicode;
-        }
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'status': 'error', 'message': f'Upload is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB'}), 413
 
-        function onGifSearchKey(event) {
-            if (event.key === 'Enter') searchGifs();
-        }
+@app.errorhandler(BrokerUnavailable)
+def broker_unavailable(e):
+    return jsonify({'status': 'error', 'message': 'Chat backend unavailable, try again shortly'}), 503
 
-        function scrollToBottom() {
-            messagesContainer.scrollTop = messagesContainer.scrollHeight;
-        }
+@app.before_request
+def start_request_timer():
+    request.environ['chat.started'] = time.perf_counter()
+    if PROFILE_DIR and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return  # another request on this thread is already being profiled
+        request.environ['chat.profiler'] = profiler
 
-        // --- Message Rendering ---
-        function isMediaUrl(text) {
-            return text.startsWith('data:image') || text.startsWith('https://media.tenor.com/') || text.includes('/media/') || text.endsWith('.gif') || text.includes('tenor.googleapis.com');
-        }
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - request.environ.get('chat.started', time.perf_counter())
+    # The rule (e.g. /media/<digest>), not the path, so every URL doesn't get its own series
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('chat_http_requests_total', 'HTTP requests handled',
+                route=route, method=request.method, status=response.status_code)
+    metrics.observe('chat_http_request_duration_seconds', 'Time to produce the response (streams: until headers)',
+                    elapsed, route=route, method=request.method)
 
-        async function fetchMessages() {
-            if (!currentGroup) return;
-            try {
-                const response = await fetch(`/messages?group=${encodeURIComponent(currentGroup)}`);
-                if (!response.ok) throw new Error('Network response was not ok');
-                const messages = await response.json();
-                
-                const isScrolledToBottom = messagesContainer.scrollHeight - messagesContainer.clientHeight <= messagesContainer.scrollTop + 1;
+    profiler = request.environ.pop('chat.profiler', None)
+    if profiler:
+        profiler.disable()
+        if elapsed * 1000 >= PROFILE_SLOW_MS:
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-{elapsed * 1000:.0f}ms-{secrets.token_hex(3)}.prof"
+            profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    return response
 
-                messagesContainer.innerHTML = '';
-                
-                messages.forEach(msg => {
-                    const messageElement = document.createElement('div');
-                    const isCurrentUser = msg.username === username;
-                    messageElement.className = `flex flex-col ${isCurrentUser ? 'items-end' : 'items-start'}`;
-                    
-                    let messageContent;
-                    if (isMediaUrl(msg.text)) {
-                        messageContent = `<img src="${msg.text}" alt="Chat content" class="mt-1 rounded-lg max-w-full h-auto" style="max-height: 250px;">`;
-                    } else {
-                        const p = document.createElement('p');
-                        p.className = "text-md break-words";
-                        p.textContent = msg.text;
-                        messageContent = p.outerHTML;
-                    }
-
-                    messageElement.innerHTML = `
-                        <div class="max-w-xs md:max-w-md p-3 rounded-xl ${isCurrentUser ? 'bg-blue-600 text-white rounded-br-none' : 'bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded-bl-none'}">
-                            <div class="flex items-baseline space-x-2">
-                                <p class="font-semibold text-sm ${isCurrentUser ? 'text-blue-200' : 'text-gray-500'}">${isCurrentUser ? 'You' : msg.username}</p>
-                                <p class="text-xs ${isCurrentUser ? 'text-blue-300' : 'text-gray-400'}">${msg.timestamp}</p>
-                            </div>
-                            ${messageContent}
-                        </div>
-                    `;
-                    messagesContainer.appendChild(messageElement);
-                });
-
-                if(isScrolledToBottom) scrollToBottom();
-
-            } catch (error) {
-                console.error('Failed to fetch messages:', error);
-            }
-        }
+@app.after_request
+def compress_response(response):
+    """Compresses the other JSON responses (search results, stats, errors...) when they're big enough."""
+    if (response.mimetype != 'application/json' or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = accepted_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
-        // --- Message & Image Sending ---
-        async function handleFormSubmit(event) {
-            event.preventDefault();
-            emojiPickerContainer.classList.add('hidden');
-
-            if (selectedFile) {
-                await sendImage(selectedFile);
-                // Reset after sending
-                cancelImage.click(); // Programmatically click cancel to reset UI
-            } else {
-                const text = messageInput.value.trim();
-                if (text !== '') {
-                    sendMessage(text);
-                    messageInput.value = '';
-                }
-            }
-        }
-
-        async function sendMessage(text) {
-            if (!currentGroup) {
-                alert('No group selected.');
-                return;
-            }
-            const message = { username: username, text: text, group: currentGroup };
-            try {
-                const response = await fetch('/messages', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(message)
-                });
-                if (response.ok) {
-                    await fetchMessages(); 
-                    scrollToBottom();
-                } else {
-                    console.error('Failed to send message');
-                }
-            } catch (error) {
-                console.error('Error sending message:', error);
-            }
-        }
-        
-        // NEW: Function to upload the image file
-        async function sendImage(file) {
-            const formData = new FormData();
-            formData.append('image', file);
-            formData.append('username', username);
-            formData.append('group', currentGroup);
-
-            try {
-                const response = await fetch('/upload_image', {
-                    method: 'POST',
-                    body: formData
-                });
-                if (response.ok) {
-                    await fetchMessages();
-                    scrollToBottom();
-                } else {
-                    alert('Failed to upload image. Please try again.');
-                    console.error('Failed to send image');
-                }
-            } catch (error) {
-                console.error('Error sending image:', error);
-            }
-        }
-
-        // --- GIF Modal Logic (Tenor) ---
-        function openGifModal() {
-            if (!TENOR_API_KEY) {
-                alert("Please set your Tenor API key in the script to enable GIFs.");
-                return;
-            }
-            gifModal.classList.remove('hidden');
-            gifSearchInput.focus();
-            searchGifs('featured');
-        }
-
-        async function searchGifs(queryType = 'search') {
-            const query = gifSearchInput.value.trim();
-            const isSearching = queryType === 'search' && query !== '';
-            const endpoint = isSearching ? 'search' : 'featured';
-            
-            const params = new URLSearchParams({
-                key: TENOR_API_KEY,
-                client_key: TENOR_CLIENT_KEY,
-                limit: 24,
-            });
-            if (isSearching) params.append('q', query);
-            
-            gifResults.innerHTML = '<p class="text-center col-span-full">Loading...</p>';
-
-            try {
-                const response = await fetch(`https://tenor.googleapis.com/v2/${endpoint}?${params}`);
-                if (!response.ok) throw new Error('Tenor API request failed');
-                const result = await response.json();
-                
-                gifResults.innerHTML = '';
-                (result.results || []).forEach(gif => {
-                    const gifItem = document.createElement('div');
-                    gifItem.className = 'gif-item bg-gray-700 rounded-lg overflow-hidden';
-                    const url = gif?.media_formats?.gif?.url || '';
-                    const desc = gif?.content_description || 'GIF';
-                    if (!url) return;
-                    gifItem.innerHTML = `<img src="${url}" alt="${desc}" class="w-full h-full object-cover">`;
-                    gifItem.onclick = () => selectGif(url);
-                    gifResults.appendChild(gifItem);
-                });
-            } catch (error) {
-                gifResults.innerHTML = `<p class="text-center col-span-full text-red-400">Failed to load GIFs: ${error.message}</p>`;
-                console.error("Tenor API Error:", error);
-            }
-        }
-
-        function selectGif(gifUrl) {
-            if (!gifUrl) return;
-            sendMessage(gifUrl);
-            gifModal.classList.add('hidden');
-            gifSearchInput.value = '';
-        }
-    </script>
-</body>
-</html>
-"""
+index_template = app.jinja_env.from_string(HTML_TEMPLATE)
+index_page = (None, None)  # (groups_version, CachedBody)
 
 @app.route('/')
 def index():
     """Serves the main HTML page and injects the group list."""
-    return render_template_string(HTML_TEMPLATE, groups=GROUPS)
+    global index_page
+    version, entry = index_page
+    if version != groups_version:
+        with store_lock:
+            version, names = groups_version, sorted(groups)
+        entry = CachedBody(index_template.render(groups=names, assets=asset_urls).encode())
+        index_page = (version, entry)
+    return cached_response(entry, 'text/html')
+
+@app.route('/static/<name>', methods=['GET'])
+def get_static(name):
+    """Serves a frontend file. Its URL changes whenever its content does, so it may be cached forever."""
+    asset = static_assets.get(name)
+    if asset is None:
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    mime_type, entry = asset
+    return cached_response(entry, mime_type, 'public, max-age=31536000, immutable')
 
 @app.route('/check_group', methods=['GET'])
 def check_group():
-    """Verify group name and password using bcrypt hashes."""
+    """Verify group name and password using bcrypt hashes, and issue a session token for the group."""
     name = request.args.get('name', '')
     password = request.args.get('password', '')
 
-    if name in GROUPS and bcrypt.checkpw(password.encode(), GROUPS[name].encode()):
-        return jsonify({'status': 'success'})
+    if not allow_join_attempt(request.remote_addr):
+        return jsonify({'status': 'error', 'message': 'Too many attempts, try again later'}), 429, {'Retry-After': '60'}
+
+    entry = groups.get(name)
+    if entry:
+        valid = check_password(password, entry['password_hash'])
+        if valid is None:
+            return jsonify({'status': 'error', 'message': 'Server busy, try again shortly'}), 503, {'Retry-After': '1'}
+        if valid:
+            return jsonify({
+                'status': 'success',
+                'token': session_tokens.dumps({'group': name, 'key': entry['session_key']}),
+                'expires_in': SESSION_MAX_AGE
+            })
 
     return jsonify({'status': 'error', 'message': 'Invalid group or password'}), 401
 
+@app.route('/admin/groups', methods=['GET'])
+def list_groups():
+    """Lists the groups and whether each one is loaded (in this process) or hibernated."""
+    error = admin_error()
+    if error:
+        return error
+    with store_lock:
+        return jsonify({'groups': [{'name': name, 'loaded': name in messages} for name in sorted(groups)]})
+
+@app.route('/admin/groups', methods=['POST'])
+def create_group():
+    """Creates a group: {"name": ..., "password": ...}. Names are letters, digits, '-' and '_'."""
+    error = admin_error()
+    if error:
+        return error
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('name'), str) or not GROUP_NAME_RE.fullmatch(data['name']):
+        return jsonify({'status': 'error', 'message': 'Group names are 1 to 64 letters, digits, - or _'}), 400
+    error = password_error(data.get('password'))
+    if error:
+        return error
+    if data['name'] in groups:
+        return jsonify({'status': 'error', 'message': 'Group already exists'}), 409
+
+    broker.update_group(data['name'], new_group_entry(data['password']))
+    return jsonify({'status': 'success', 'name': data['name']}), 201
+
+@app.route('/admin/groups/<name>', methods=['DELETE'])
+def delete_group(name):
+    """Deletes a group with its history. Its sessions end."""
+    error = admin_error()
+    if error:
+        return error
+    if name not in groups:
+        return jsonify({'status': 'error', 'message': 'No such group'}), 404
+
+    broker.update_group(name, None)
+    return jsonify({'status': 'success'})
+
+@app.route('/admin/groups/<name>/password', methods=['PUT'])
+def set_group_password(name):
+    """Gives a group a new password: {"password": ...}. Sessions issued under the old one end."""
+    error = admin_error()
+    if error:
+        return error
+    if name not in groups:
+        return jsonify({'status': 'error', 'message': 'No such group'}), 404
+    data = request.get_json(silent=True)
+    error = password_error(data.get('password') if isinstance(data, dict) else None)
+    if error:
+        return error
+
+    broker.update_group(name, new_group_entry(data['password']))
+    return jsonify({'status': 'success'})
+
 @app.route('/messages', methods=['GET'])
 def get_messages():
-    """Returns all chat messages for a specific group in JSON format."""
+    """Returns a page of the group's messages: the latest ones, or those after `since` (or `after`) or before `before`.
+
+    Polls that pass `username` keep that user online; `typing=1` shows them as typing.
+    Clients that accept COMPACT_MIMETYPE get the messages as rows.
+    """
     group = request.args.get('group')
-    if not group or group not in messages:
+    if not group or group not in groups:
         return jsonify({'status': 'error', 'message': 'Invalid or missing group parameter'}), 400
-    return jsonify(messages[group])
+    error = session_error(group)
+    if error:
+        return error
+
+    try:
+        since = request.args.get('since', request.args.get('after'))
+        since = int(since) if since is not None else None
+        before = request.args.get('before')
+        before = int(before) if before is not None else None
+        limit = int(request.args.get('limit', DEFAULT_FETCH_LIMIT))
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid since, before, limit or wait parameter'}), 400
+    limit = min(max(limit, 1), MAX_FETCH_LIMIT)
+    update_presence(group, request.args.get('username'), True if request.args.get('typing') == '1' else None)
+
+    # Long-poll: hold the request open until something newer than the cursor arrives (or someone
+    # joins, leaves or starts typing).
+    if wait > 0 and since is not None:
+        with pollers.tracking(kind='long_poll'):
+            wait_for_messages(group, since, min(wait, MAX_LONG_POLL_WAIT), presence_tracker.version(group))
+
+    compact = request.accept_mimetypes.best_match(['application/json', COMPACT_MIMETYPE]) == COMPACT_MIMETYPE
+    return cached_response(cached_messages_body(group, limit, since, before, compact),
+                           COMPACT_MIMETYPE if compact else 'application/json', vary='Accept, Accept-Encoding')
+
+@app.route('/presence', methods=['GET'])
+def get_presence():
+    """Who's online in the group and who's typing."""
+    group = request.args.get('group')
+    if not group or group not in groups:
+        return jsonify({'status': 'error', 'message': 'Invalid or missing group parameter'}), 400
+    error = session_error(group)
+    if error:
+        return error
+
+    update_presence(group)
+    _, summary = presence_summary(group)
+    return jsonify(summary)
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Reports memory held by the message and media stores, and how much has been evicted."""
+    with store_lock:
+        return jsonify({
+            'held_bytes': held_bytes(),
+            'media_bytes': stats['media_bytes'],
+            'media_count': len(media),
+            'evicted_messages': stats['evicted_messages'],
+            'evicted_media': stats['evicted_media'],
+            'group_count': len(groups),
+            # Only the loaded ones; the rest are hibernated
+            'groups': {
+                name: {'messages': history.count, 'bytes': history.bytes}
+                for name, history in messages.items()
+            },
+            'limits': {
+                'max_messages_per_group': MAX_MESSAGES_PER_GROUP,
+                'max_bytes_per_group': MAX_BYTES_PER_GROUP,
+                'memory_budget_bytes': MEMORY_BUDGET_BYTES
+            }
+        })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request counters, latency histograms, hot-section timers and store gauges for Prometheus."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Most results one GET /search returns
+MAX_SEARCH_RESULTS = 100
+
+@app.route('/search', methods=['GET'])
+def search_messages():
+    """Finds the group's messages containing every word of `q` (words may be prefixes), newest first.
+
+    Pass the returned `before` back to get the next (older) page of results.
+    """
+    group = request.args.get('group')
+    if not group or group not in groups:
+        return jsonify({'status': 'error', 'message': 'Invalid or missing group parameter'}), 400
+    error = session_error(group)
+    if error:
+        return error
+
+    query = request.args.get('q', '')
+    if not search.tokenize(query):
+        return jsonify({'status': 'error', 'message': 'Missing search words'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), MAX_SEARCH_RESULTS)
+        before = request.args.get('before')
+        before = int(before) if before is not None else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid limit or before parameter'}), 400
+
+    with metrics.timed('search'), store_lock:
+        history = messages[group]
+        # One extra to know whether there's another page
+        ids = history.index.search(query, history.last_id + 1 if before is None else before, limit + 1)
+        results = [history.get(message_id) for message_id in ids[:limit]]
+    return jsonify({
+        'messages': [message.to_dict() for message in results],
+        'before': results[-1].id if results else before,
+        'more': len(ids) > limit
+    })
+
+@app.route('/stream', methods=['GET'])
+def stream_messages():
+    """Server-Sent Events feed that pushes new messages for a group as they are posted.
+
+    Presence changes are sent as `presence` events; `username` keeps that user online while connected.
+    """
+    group = request.args.get('group')
+    if not group or group not in groups:
+        return jsonify({'status': 'error', 'message': 'Invalid or missing group parameter'}), 400
+    error = session_error(group)
+    if error:
+        return error
+
+    # EventSource sends Last-Event-ID when it reconnects, so we resume where the client left off.
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid since parameter'}), 400
+
+    username = request.args.get('username')
+    session = request_session()
+
+    def events():
+        cursor = since
+        shown = None  # presence version last sent
+        with pollers.tracking(kind='stream'):
+            # Ends if the group is deleted or the session ends (expired, or the password changed)
+            while session_current(session) and open_group(group):
+                update_presence(group, username)
+                version, summary = presence_summary(group)
+                if version != shown:
+                    shown = version
+                    yield format_presence_sse(summary)
+                wait_for_messages(group, cursor, STREAM_KEEPALIVE, shown)
+                batch = messages_after(group, cursor, MAX_FETCH_LIMIT)
+                if batch:
+                    cursor = batch[-1].id
+                    yield format_sse(batch)
+                elif presence_tracker.version(group) == shown:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/messages', methods=['POST'])
 def post_message():
-    """Receives a new text message and adds it to the group's list."""
+    """Receives a new text message and adds it to the group's list. Resent with the same `key`, it's stored once."""
     data = request.get_json()
-    if not data or 'username' not in data or 'text' not in data or 'group' not in data:
+    if (not isinstance(data, dict) or not isinstance(data.get('group'), str)
+            or not valid_message(data.get('username'), data.get('text')) or not valid_post_key(data.get('key'))):
         return jsonify({'status': 'error', 'message': 'Invalid data'}), 400
 
     group = data['group']
-    if group not in messages:
+    if group not in groups:
         return jsonify({'status': 'error', 'message': 'Invalid group'}), 400
+    error = session_error(group)
+    if error:
+        return error
 
-    message = {
-        'username': data['username'],
-        'text': data['text'],
-        'timestamp': datetime.datetime.now().strftime('%H:%M')
-    }
-    messages[group].append(message)
-    return jsonify({'status': 'success'}), 201
+    message = append_message(group, data['username'], data['text'], key=data.get('key'))
+    update_presence(group, data['username'], typing=False)
+    return jsonify({'status': 'success', 'id': message.id}), 201
+
+# Most messages one POST /messages/batch may carry
+MAX_BATCH_MESSAGES = 100
+
+@app.route('/messages/batch', methods=['POST'])
+def post_messages():
+    """Adds several messages at once: {"group": ..., "messages": [{"username": ..., "text": ...}, ...]}."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('messages'), list) or not isinstance(data.get('group'), str):
+        return jsonify({'status': 'error', 'message': 'Invalid data'}), 400
+    if not 0 < len(data['messages']) <= MAX_BATCH_MESSAGES:
+        return jsonify({'status': 'error', 'message': f'Send between 1 and {MAX_BATCH_MESSAGES} messages'}), 400
+    if not all(isinstance(m, dict) and valid_message(m.get('username'), m.get('text')) for m in data['messages']):
+        return jsonify({'status': 'error', 'message': 'Every message needs a username and text'}), 400
+
+    group = data['group']
+    if group not in groups:
+        return jsonify({'status': 'error', 'message': 'Invalid group'}), 400
+    error = session_error(group)
+    if error:
+        return error
+
+    stored = append_messages(group, [(m['username'], m['text'], None) for m in data['messages']])
+    return jsonify({'status': 'success', 'ids': [message.id for message in stored]}), 201
 
 # --- NEW: Route for handling image uploads ---
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
-    """Receives an uploaded image, encodes it to base64, and adds it as a message."""
+    """Receives an uploaded image, stores it in the blob store, and adds a /media/ link as a message."""
     if 'image' not in request.files:
         return jsonify({'status': 'error', 'message': 'No image part'}), 400
 
@@ -541,25 +1773,57 @@ def upload_image():
     if file.filename == '':
         return jsonify({'status': 'error', 'message': 'No selected file'}), 400
         
-    if group not in messages:
+    if group not in groups:
         return jsonify({'status': 'error', 'message': 'Invalid group'}), 400
+    error = session_error(group)
+    if error:
+        return error
 
-    # Encode the image to a base64 data URL
+    mime_type = file.mimetype
+    if not mime_type.startswith('image/'):
+        return jsonify({'status': 'error', 'message': 'Only image uploads are supported'}), 400
+
+    data = file.read()
+    if not images.Image:
+        # No Pillow: store the upload exactly as sent
+        digest = store_media(data, mime_type)
+        message = append_message(group, username, f'/media/{digest}')
+        return jsonify({'status': 'success', 'id': message.id}), 201
+
+    # The chat shows a small thumbnail that links to the full-size version
     try:
-        encoded_string = base64.b64encode(file.read()).decode('utf-8')
-        mime_type = file.content_type
-        image_data_url = f"data:{mime_type};base64,{encoded_string}"
+        with metrics.timed('image_process'):
+            versions = process_upload(data, mime_type)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Could not process file: {e}'}), 500
+    (thumbnail, thumbnail_type), (full, full_type) = versions
+    thumbnail_digest = store_media(thumbnail, thumbnail_type)
+    full_digest = store_media(full, full_type)
+
+    message = append_message(group, username, f'/media/{thumbnail_digest}', f'/media/{full_digest}')
+    return jsonify({'status': 'success', 'id': message.id}), 201
 
+@app.route('/media/<digest>', methods=['GET'])
+def get_media(digest):
+    """Serves a stored image. Content never changes for a hash, so browsers may cache it forever."""
+    # Media evicted from memory (or uploaded before a restart) may still be on disk
+    blob = media.get(digest) or load_media_from_disk(digest)
+    if blob is None:
+        return jsonify({'status': 'error', 'message': 'Media not found'}), 404
 
-    message = {
-        'username': username,
-        'text': image_data_url,  # The text is now the image data URL
-        'timestamp': datetime.datetime.now().strftime('%H:%M')
+    mime_type, data = blob
+    headers = {
+        'ETag': f'"{digest}"',
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'X-Content-Type-Options': 'nosniff',
+        # Uploaded SVGs must not be able to run script on our origin
+        'Content-Security-Policy': "default-src 'none'; style-src 'unsafe-inline'; sandbox"
     }
-    messages[group].append(message)
-    return jsonify({'status': 'success'}), 201
+    if digest in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(data, mimetype=mime_type, headers=headers)
 
 
 if __name__ == '__main__':
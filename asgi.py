@@ -0,0 +1,428 @@
+# asgi.py
+# Production entry point: serves the chat app from an asyncio (ASGI) server instead of
+# app.run(debug=True).
+# - GET /stream and long-polling GET /messages?wait=... are handled natively with asyncio,
+#   so an idle client costs an open socket and a small coroutine instead of a blocked thread.
+# - /ws is a WebSocket per group: it pushes new messages and accepts posts.
+# - Every other request runs the Flask app from app.py on a bounded thread pool.
+#
+# Run it (no debug reloader) with:
+#     python asgi.py --host 0.0.0.0 --port 5000 --keepalive 5
+# or point any ASGI server at `asgi:application`.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode
+
+import app as chat
+import metrics
+from broker import BrokerUnavailable
+
+# Flask requests run on this pool. Streams and long-polls never occupy one of its threads.
+FLASK_THREADS = int(os.environ.get('CHAT_FLASK_THREADS', 32))
+flask_pool = ThreadPoolExecutor(max_workers=FLASK_THREADS, thread_name_prefix='flask')
+
+class GroupNotifier:
+    """Per-group asyncio events, set from any thread when a group gets a new message.
+
+    Only groups with someone waiting have an event, so idle groups cost nothing.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.events = {}
+
+    def notify(self, group, batch):
+        # Called from whichever thread appended the batch
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.wake, group)
+
+    def wake(self, group):
+        event = self.events.pop(group, None)
+        if event:
+            event.set()
+
+    async def wait(self, group, since, timeout, presence_version=None):
+        """Waits until the group has a message newer than `since`, or `timeout` seconds pass.
+
+        With `presence_version`, also returns as soon as the group's presence moves past it.
+        """
+        event = self.events.setdefault(group, asyncio.Event())
+        history = chat.messages.get(group)
+        if history is None or history.last_id > since:
+            return
+        if presence_version is not None and chat.presence_tracker.version(group) != presence_version:
+            return
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+notifier = GroupNotifier()
+chat.message_listeners.append(notifier.notify)
+chat.presence_listeners.append(lambda group: notifier.notify(group, None))
+chat.group_listeners.append(lambda name, entry: notifier.notify(name, None))
+
+# Frames waiting to be sent to one WebSocket client. A client that falls this far behind is
+# disconnected (it resumes from its cursor when it reconnects) instead of buffering forever.
+WS_SEND_QUEUE = int(os.environ.get('CHAT_WS_SEND_QUEUE', 64))
+# Largest frame a client may send
+WS_MAX_MESSAGE_BYTES = 64 * 1024
+# Close code for slow consumers: 1013 "try again later"
+WS_TOO_SLOW = 1013
+
+def request_token(scope, query):
+    """Session token from the Authorization header or the `token` query parameter."""
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            return value.decode('latin-1').removeprefix('Bearer ').strip()
+    return query.get('token', [''])[0]
+
+def header(scope, wanted):
+    for name, value in scope['headers']:
+        if name == wanted:
+            return value.decode('latin-1')
+    return None
+
+async def authorized_session(scope, query):
+    """The request's session (see app.read_session) if it's for the requested group, else None.
+
+    Requests we can't serve natively fall through to Flask, which sends the proper error.
+    """
+    group = query.get('group', [''])[0]
+    session = chat.read_session(request_token(scope, query))
+    if group not in chat.groups or not session or session[0] != group:
+        return None
+    # Waking a hibernated group reads its history from disk (or the hub): not on the event loop
+    if not await asyncio.get_running_loop().run_in_executor(flask_pool, chat.open_group, group):
+        return None
+    return session
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def stream_messages(scope, receive, send, session, since, username):
+    """Native version of app.stream_messages."""
+    group = session[0]
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    metrics.inc('chat_http_requests_total', 'HTTP requests handled', route='/stream', method='GET', status=200)
+    chat.pollers.inc(kind='stream')
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    cursor = since
+    shown = None  # presence version last sent
+    try:
+        # Ends if the group is deleted or the session ends (expired, or the password changed)
+        while chat.session_current(session) and chat.touch_group(group):
+            chat.update_presence(group, username)
+            version, summary = chat.presence_summary(group)
+            if version != shown:
+                shown = version
+                await send({'type': 'http.response.body', 'body': chat.format_presence_sse(summary).encode(), 'more_body': True})
+            batch = chat.messages_after(group, cursor, chat.MAX_FETCH_LIMIT)
+            if batch:
+                cursor = batch[-1].id
+                await send({'type': 'http.response.body', 'body': chat.format_sse(batch).encode(), 'more_body': True})
+                continue
+            waiting = asyncio.ensure_future(notifier.wait(group, cursor, chat.STREAM_KEEPALIVE, shown))
+            await asyncio.wait({waiting, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiting.cancel()
+                return
+            history = chat.messages.get(group)
+            if history and history.last_id <= cursor and chat.presence_tracker.version(group) == shown:
+                # Comment line keeps proxies from closing an idle connection
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        chat.pollers.dec(kind='stream')
+
+class SlowConsumer(Exception):
+    pass
+
+def enqueue(outbox, frame):
+    try:
+        outbox.put_nowait(frame)
+    except asyncio.QueueFull:
+        raise SlowConsumer
+
+async def push_messages(outbox, session, since, username, compact):
+    """Queues a page for every batch of new messages (clients at the same cursor share one encoded
+    page) and a {"presence": ...} frame whenever the group's presence changes."""
+    group = session[0]
+    cursor = since
+    shown = None
+    # Returns if the group is deleted or the session ends
+    while chat.session_current(session) and chat.touch_group(group):
+        chat.update_presence(group, username)
+        version, summary = chat.presence_summary(group)
+        if version != shown:
+            shown = version
+            enqueue(outbox, json.dumps({'presence': summary}))
+        page = chat.cached_messages_body(group, chat.MAX_FETCH_LIMIT, cursor, compact=compact)
+        if page.cursor > cursor:
+            enqueue(outbox, page.body.decode())
+            cursor = page.cursor
+            continue
+        await notifier.wait(group, cursor, chat.STREAM_KEEPALIVE, shown)
+
+async def receive_posts(receive, outbox, session, username):
+    """Stores {"username", "text", "ref", "key"} frames from the client and queues an ack (or error) for each.
+
+    `key` is optional; a post resent over HTTP with the same key isn't stored twice (see app.valid_post_key).
+
+    {"typing": true/false} frames start or stop showing the connection's user as typing.
+    Returns when the client disconnects, or sends something after its session has ended.
+    """
+    group = session[0]
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await receive()
+        if message['type'] == 'websocket.disconnect' or not chat.session_current(session):
+            return
+        try:
+            data = json.loads(message.get('text') or message.get('bytes') or b'')
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and 'typing' in data:
+            chat.update_presence(group, username, bool(data['typing']))
+            continue
+        ref = data.get('ref') if isinstance(data, dict) else None
+        if (not isinstance(data, dict) or not chat.valid_message(data.get('username'), data.get('text'))
+                or not chat.valid_post_key(data.get('key'))):
+            enqueue(outbox, json.dumps({'status': 'error', 'message': 'Invalid data', 'ref': ref}))
+            continue
+        author, text = data['username'], data['text']
+        try:
+            # Appending can wait on the broker or the log's fsync, so it runs off the event loop
+            stored = await loop.run_in_executor(flask_pool, chat.append_message, group, author, text, None, data.get('key'))
+            chat.update_presence(group, author, typing=False)
+            reply = {'status': 'success', 'id': stored.id, 'ref': ref}
+        except BrokerUnavailable:
+            reply = {'status': 'error', 'message': 'Chat backend unavailable, try again shortly', 'ref': ref}
+        except Exception as e:
+            # One failed post doesn't end the connection
+            print(f'websocket post failed: {e!r}', file=sys.stderr)
+            reply = {'status': 'error', 'message': 'Could not store message', 'ref': ref}
+        enqueue(outbox, json.dumps(reply))
+
+async def send_frames(send, outbox):
+    while True:
+        await send({'type': 'websocket.send', 'text': await outbox.get()})
+
+async def websocket_session(scope, receive, send):
+    """WebSocket at /ws?group=...&since=...&token=...&username=...: pushes message pages and presence
+    as they change and accepts posts. With `compact=1` pages list messages as rows (see app.COMPACT_MIMETYPE)."""
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    session = await authorized_session(scope, query)
+    try:
+        since = max(int(query.get('since', ['0'])[0]), 0)
+    except ValueError:
+        session = None
+    if not session:
+        # Closing before accepting rejects the handshake (403)
+        await send({'type': 'websocket.close', 'code': 1008})
+        return
+    username = query.get('username', [None])[0]
+    compact = query.get('compact', [''])[0] == '1'
+    await send({'type': 'websocket.accept'})
+    metrics.inc('chat_http_requests_total', 'HTTP requests handled', route='/ws', method='GET', status=101)
+
+    # Only send_frames talks to the client, so a slow one backs up `outbox`, not the server
+    outbox = asyncio.Queue(WS_SEND_QUEUE)
+    tasks = [
+        asyncio.ensure_future(receive_posts(receive, outbox, session, username)),
+        asyncio.ensure_future(push_messages(outbox, session, since, username, compact)),
+        asyncio.ensure_future(send_frames(send, outbox)),
+    ]
+    with chat.pollers.tracking(kind='websocket'):
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+    for task in done:
+        code = None
+        if isinstance(task.exception(), SlowConsumer):
+            metrics.inc('chat_websocket_slow_consumers_total', 'WebSocket clients disconnected for falling behind')
+            code = WS_TOO_SLOW
+        elif not chat.session_current(session):
+            # Deleted group, or the session expired or was voided by a new password
+            code = 1008 if session[0] in chat.groups else 1001
+        elif task is tasks[1]:
+            code = 1001  # Group unloaded
+        if code:
+            try:
+                await send({'type': 'websocket.close', 'code': code})
+            except Exception:
+                pass  # already gone
+
+def build_environ(scope, body):
+    """Translates an ASGI HTTP scope into a WSGI environ."""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+        'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The whole body has been read already, so Flask can read chunked uploads to EOF
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+def run_flask(scope, body):
+    """Runs one request through the Flask app (on a pool thread) and returns the full response."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = chat.app(build_environ(scope, body), start_response)
+    try:
+        content = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], content
+
+async def call_flask(scope, receive, send):
+    limit = chat.app.config['MAX_CONTENT_LENGTH']
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as body:
+        # An oversized Content-Length is left for Flask to refuse (413) without reading the body
+        if int(header(scope, b'content-length') or 0) <= limit:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if body.tell() > limit:
+                    # Chunked upload that turned out too big: stop reading it
+                    await send({'type': 'http.response.start', 'status': 413, 'headers': [(b'content-type', b'application/json')]})
+                    await send({'type': 'http.response.body', 'body': json.dumps({
+                        'status': 'error',
+                        'message': f'Upload is larger than {limit // (1024 * 1024)} MB'
+                    }).encode()})
+                    return
+                if not message.get('more_body'):
+                    break
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(flask_pool, run_flask, scope, body)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': content})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    notifier.loop = asyncio.get_running_loop()
+    if scope['type'] == 'websocket' and scope['path'] == '/ws':
+        return await websocket_session(scope, receive, send)
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] == 'GET' and scope['path'] in ('/stream', '/messages'):
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        session = await authorized_session(scope, query)
+        group = session and session[0]
+        try:
+            if group and scope['path'] == '/stream':
+                since = int(header(scope, b'last-event-id') or query.get('since', ['0'])[0])
+                return await stream_messages(scope, receive, send, session, since, query.get('username', [None])[0])
+            if group and 'wait' in query and ('since' in query or 'after' in query):
+                since = int(query.get('since', query.get('after'))[0])
+                wait = min(float(query['wait'][0]), chat.MAX_LONG_POLL_WAIT)
+                chat.update_presence(group, query.get('username', [None])[0])
+                with chat.pollers.tracking(kind='long_poll'):
+                    await notifier.wait(group, since, wait, chat.presence_tracker.version(group))
+                # We've done the waiting; Flask just answers with whatever is there now
+                del query['wait']
+                scope = dict(scope, query_string=urlencode(query, doseq=True).encode())
+        except ValueError:
+            pass  # Bad parameters: let Flask send the error
+
+    await call_flask(scope, receive, send)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the chat server on uvicorn (asyncio) without the debug reloader.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--keepalive', type=int, default=5, help='seconds to keep idle HTTP connections open')
+    parser.add_argument('--threads', type=int, default=FLASK_THREADS, help='threads per worker for non-streaming requests')
+    parser.add_argument('--backlog', type=int, default=2048, help='pending connection queue size')
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("async mode needs uvicorn: pip install 'uvicorn[standard]'")
+
+    if args.workers > 1 and not chat.BROKER_ADDRESS:
+        # Without a broker hub each worker process keeps its own copy of the chat state
+        print('warning: workers do not share chat history unless CHAT_BROKER points at a '
+              '`python broker.py` hub', file=sys.stderr)
+        if chat.DATA_DIR:
+            parser.error('CHAT_DATA_DIR needs a broker hub (CHAT_BROKER) to be shared by several workers')
+
+    # Worker processes re-import this module, so pass the pool size through the environment, and
+    # the session signing key too: without CHAT_SECRET_KEY each worker would pick its own and
+    # refuse the tokens the others hand out
+    os.environ['CHAT_FLASK_THREADS'] = str(args.threads)
+    os.environ.setdefault('CHAT_SECRET_KEY', chat.app.secret_key)
+    global flask_pool
+    flask_pool = ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix='flask')
+
+    uvicorn.run(
+        'asgi:application' if args.workers > 1 else application,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_keep_alive=args.keepalive,
+        backlog=args.backlog,
+        ws_max_size=WS_MAX_MESSAGE_BYTES,
+        log_level='info',
+    )
+
+if __name__ == '__main__':
+    main()
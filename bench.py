@@ -0,0 +1,322 @@
+# bench.py
+# Load test / latency benchmark for the chat endpoints.
+# - Runs in-process against the Flask test client (default) or against a running server (--url).
+# - Simulates N pollers per group, a steady post rate with a mix of image uploads, and a
+#   storm of /check_group joins part way through.
+# - Prints one JSON report (throughput, p50/p95/p99 latency, bytes per request, RSS over time)
+#   that can be saved with --output and compared against an earlier run with --compare.
+# - --memory instead measures the bytes each stored message costs, as app.Message and as the
+#   plain dict the store used to keep.
+#
+#     python bench.py --duration 20 --pollers 50
+#     python bench.py --url http://127.0.0.1:5000 --password secret --server-pid 1234
+#     python bench.py --output after.json --compare before.json
+#     python bench.py --memory
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import resource
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import zlib
+from collections import defaultdict
+from urllib.parse import quote, urlparse
+
+BENCH_PASSWORD = 'bench-password'
+
+def make_png(size):
+    """A valid PNG of random noise, roughly `size` bytes (noise doesn't compress)."""
+    side = max(8, int((size / 3) ** 0.5))
+    rows = b''.join(b'\x00' + os.urandom(side * 3) for _ in range(side))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows, 1)) + chunk(b'IEND', b'')
+
+def multipart(fields, file_field, filename, data, mime_type):
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode() for k, v in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f'Content-Type: {mime_type}\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+class TestClientTransport:
+    """Sends requests through Flask's test client, in this process."""
+
+    def __init__(self, chat):
+        self.chat = chat
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None, remote_addr='127.0.0.1'):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.chat.app.test_client()
+        response = self.local.client.open(path, method=method, data=body, headers=headers or {},
+                                          environ_base={'REMOTE_ADDR': remote_addr})
+        return response.status_code, response.get_data()
+
+class HttpTransport:
+    """Sends requests to a running server, one keep-alive connection per thread."""
+
+    def __init__(self, url):
+        self.url = urlparse(url)
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None, remote_addr=None):
+        for attempt in range(2):
+            if not hasattr(self.local, 'conn'):
+                self.local.conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+            try:
+                self.local.conn.request(method, path, body=body, headers=headers or {})
+                response = self.local.conn.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                # Server closed the idle keep-alive connection; reconnect once
+                self.local.conn.close()
+                del self.local.conn
+                if attempt:
+                    raise
+
+class Recorder:
+    """Collects latency, status and size of every request, per operation."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)  # op -> [(latency seconds, status, bytes)]
+
+    def timed(self, op, transport, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            status, body = transport.request(*args, **kwargs)
+        except Exception:
+            status, body = 0, b''
+        with self.lock:
+            self.samples[op].append((time.perf_counter() - start, status, len(body)))
+        return status, body
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(samples, duration):
+    report = {}
+    for op, rows in sorted(samples.items()):
+        latencies = sorted(latency for latency, _, _ in rows)
+        statuses = defaultdict(int)
+        for _, status, _ in rows:
+            statuses[str(status)] += 1
+        report[op] = {
+            'count': len(rows),
+            'errors': sum(1 for _, status, _ in rows if status == 0 or status >= 400),
+            'throughput_per_s': round(len(rows) / duration, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+            'bytes_per_request': round(sum(size for _, _, size in rows) / len(rows), 1),
+            'statuses': dict(statuses),
+        }
+    return report
+
+def rss_bytes(pid):
+    """Current resident set size of `pid` (Linux), falling back to this process's peak RSS."""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run(args, transport, tokens):
+    recorder = Recorder()
+    stop = threading.Event()
+    started = time.perf_counter()
+    groups = args.groups
+    image = make_png(args.image_size)
+
+    def poller(group):
+        cursor = 0
+        headers = {'Authorization': f'Bearer {tokens[group]}'}
+        wait = f'&wait={args.wait}' if args.wait else ''
+        while not stop.is_set():
+            status, body = recorder.timed('poll', transport, 'GET', f'/messages?group={quote(group)}&since={cursor}{wait}', headers=headers)
+            if status == 200:
+                cursor = json.loads(body)['cursor']
+            stop.wait(args.poll_interval)
+
+    def poster(index):
+        # Posters share the total rate; each one sends every `interval` seconds
+        interval = args.posters / args.post_rate if args.post_rate else None
+        rng = random.Random(index)
+        while not stop.wait(interval or 0):
+            group = rng.choice(groups)
+            headers = {'Authorization': f'Bearer {tokens[group]}'}
+            if rng.random() < args.upload_ratio:
+                body, content_type = multipart({'username': f'bench{index}', 'group': group}, 'image', 'bench.png', image, 'image/png')
+                recorder.timed('upload', transport, 'POST', '/upload_image', body=body,
+                               headers={**headers, 'Content-Type': content_type})
+            else:
+                body = json.dumps({'username': f'bench{index}', 'text': f'message {rng.random()}', 'group': group})
+                recorder.timed('post', transport, 'POST', '/messages', body=body,
+                               headers={**headers, 'Content-Type': 'application/json'})
+
+    def joiner(index):
+        group = groups[index % len(groups)]
+        recorder.timed('join', transport, 'GET', f'/check_group?name={quote(group)}&password={quote(args.password)}',
+                       remote_addr=f'10.0.{index // 250}.{index % 250 + 1}')
+
+    def join_storm():
+        if stop.wait(args.join_storm_at) or not args.password:
+            return
+        threads = [threading.Thread(target=joiner, args=(i,)) for i in range(args.joiners)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    threads = [threading.Thread(target=poller, args=(g,)) for g in groups for _ in range(args.pollers)]
+    if args.post_rate:
+        threads += [threading.Thread(target=poster, args=(i,)) for i in range(args.posters)]
+    if args.joiners:
+        threads.append(threading.Thread(target=join_storm))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    rss = []
+    while time.perf_counter() - started < args.duration:
+        rss.append([round(time.perf_counter() - started, 1), rss_bytes(args.server_pid or os.getpid())])
+        time.sleep(min(args.sample_interval, max(0, args.duration - (time.perf_counter() - started))))
+    rss.append([round(time.perf_counter() - started, 1), rss_bytes(args.server_pid or os.getpid())])
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=args.wait + 5)
+    duration = time.perf_counter() - started
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('password', 'output', 'compare')},
+        'duration_s': round(duration, 2),
+        'ops': summarize(recorder.samples, duration),
+        'rss_bytes': rss,
+        'rss_growth_bytes': rss[-1][1] - rss[0][1],
+    }
+
+def memory_benchmark(count):
+    """Bytes per stored message (record, strings and list slot) as a dict and as app.Message."""
+    import app as chat
+    rng = random.Random(1)
+    names = [f'user{i}' for i in range(20)]
+    words = ['ok', 'lol', 'see', 'you', 'tomorrow', 'sounds', 'good', 'where', 'are', 'we', 'meeting', 'haha', 'yes', 'no']
+    # Raw request bodies, so every message arrives with freshly parsed strings like a real post
+    bodies = [json.dumps({'username': rng.choice(names), 'text': ' '.join(rng.choices(words, k=rng.randint(1, 12)))})
+              for _ in range(count)]
+
+    def as_dict(i, data):
+        return {'id': i, 'username': data['username'], 'text': data['text'],
+                'timestamp': datetime.datetime.now().strftime('%H:%M')}
+
+    def as_message(i, data):
+        return chat.Message(i, data['username'], data['text'], int(time.time()))
+
+    result = {'messages': count}
+    for name, build in (('dict', as_dict), ('message', as_message)):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        store = [build(i, json.loads(body)) for i, body in enumerate(bodies)]
+        result[f'{name}_bytes_per_message'] = round((tracemalloc.get_traced_memory()[0] - before) / count, 1)
+        tracemalloc.stop()
+        del store
+    result['saved_percent'] = round(100 - result['message_bytes_per_message'] / result['dict_bytes_per_message'] * 100, 1)
+    result['average_text_bytes'] = round(sum(len(json.loads(body)['text']) for body in bodies) / count, 1)
+    result['estimated_bytes_per_message'] = chat.MESSAGE_OVERHEAD_BYTES + result['average_text_bytes']
+    return result
+
+def compare(report, baseline):
+    """Prints p95 latency and throughput changes relative to an earlier report."""
+    for op, now in report['ops'].items():
+        before = baseline.get('ops', {}).get(op)
+        if not before:
+            continue
+        p95 = (now['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+        rate = (now['throughput_per_s'] - before['throughput_per_s']) / before['throughput_per_s'] * 100 if before['throughput_per_s'] else 0
+        print(f"{op:8} p95 {before['p95_ms']:9.3f} -> {now['p95_ms']:9.3f} ms ({p95:+.1f}%)   "
+              f"throughput {before['throughput_per_s']:9.2f} -> {now['throughput_per_s']:9.2f}/s ({rate:+.1f}%)",
+              file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the chat endpoints.')
+    parser.add_argument('--url', help='benchmark a running server instead of the in-process test client')
+    parser.add_argument('--password', help='group password, for join storms against --url (the test client uses its own)')
+    parser.add_argument('--secret', help="server's CHAT_SECRET_KEY, to mint session tokens for --url without joining")
+    parser.add_argument('--server-pid', type=int, help='sample RSS of this process (default: this process)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run')
+    parser.add_argument('--groups', nargs='+', default=['friends', 'family'], help='groups to load')
+    parser.add_argument('--pollers', type=int, default=20, help='pollers per group')
+    parser.add_argument('--poll-interval', type=float, default=2, help='seconds between polls (the frontend uses 2)')
+    parser.add_argument('--wait', type=float, default=0, help='long-poll wait parameter for pollers')
+    parser.add_argument('--posters', type=int, default=4, help='posting threads')
+    parser.add_argument('--post-rate', type=float, default=20, help='posts per second, all posters together')
+    parser.add_argument('--upload-ratio', type=float, default=0.05, help='fraction of posts that are image uploads')
+    parser.add_argument('--image-size', type=int, default=200 * 1024, help='bytes per uploaded image')
+    parser.add_argument('--joiners', type=int, default=30, help='concurrent /check_group calls in the join storm')
+    parser.add_argument('--join-storm-at', type=float, default=2, help='seconds into the run to start the join storm')
+    parser.add_argument('--sample-interval', type=float, default=1, help='seconds between RSS samples')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    parser.add_argument('--memory', action='store_true', help='measure bytes per stored message instead of load testing')
+    parser.add_argument('--messages', type=int, default=100000, help='messages to store for --memory')
+    args = parser.parse_args()
+
+    if args.memory:
+        print(json.dumps(memory_benchmark(args.messages), indent=2))
+        return
+
+    if args.url:
+        transport = HttpTransport(args.url)
+        if args.secret:
+            from itsdangerous import URLSafeTimedSerializer
+            serializer = URLSafeTimedSerializer(args.secret, salt='group-session')
+            tokens = {g: serializer.dumps({'group': g}) for g in args.groups}
+        elif args.password:
+            tokens = {}
+            for g in args.groups:
+                status, body = transport.request('GET', f'/check_group?name={quote(g)}&password={quote(args.password)}')
+                if status != 200:
+                    parser.error(f'could not join {g}: HTTP {status}')
+                tokens[g] = json.loads(body)['token']
+        else:
+            parser.error('--url needs --password or --secret to get session tokens')
+    else:
+        import bcrypt
+        import app as chat
+        # Throwaway in-process server: give the benchmarked groups a known password
+        hashed = bcrypt.hashpw(BENCH_PASSWORD.encode(), bcrypt.gensalt(12)).decode()
+        for g in args.groups:
+            chat.apply_group(g, {'password_hash': hashed, 'session_key': ''})
+        args.password = BENCH_PASSWORD
+        transport = TestClientTransport(chat)
+        tokens = {g: chat.session_tokens.dumps({'group': g}) for g in args.groups}
+
+    report = run(args, transport, tokens)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
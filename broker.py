@@ -0,0 +1,367 @@
+# broker.py
+# Pub/sub layer that lets several chat server workers (processes, or machines) share one
+# chat state.
+# - Broker: the interface app.py publishes through. app.LocalBroker keeps everything in
+#   one process; an external system (Redis, NATS, ...) can be plugged in by implementing it.
+# - BrokerHub: a small TCP / Unix-socket server. It sequences every group's messages,
+#   keeps the authoritative history (and the message log, if CHAT_DATA_DIR is set) and the
+#   group registry, and fans each message and group change out to every connected worker.
+# - SocketBroker: the worker side of a hub connection.
+#
+# Run a hub and point the workers at it:
+#     python broker.py --listen 127.0.0.1:6000        (or --listen unix:/tmp/chat.sock)
+#     CHAT_BROKER=127.0.0.1:6000 python asgi.py --workers 4
+#
+# A worker proves it knows CHAT_BROKER_KEY before the hub sends or accepts anything: the hub
+# sends a random challenge and the worker answers with its HMAC.
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import queue
+import secrets
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Frames are two big-endian lengths, a JSON header and a binary payload (media bytes, else empty).
+FRAME_HEADER = struct.Struct('>II')
+# How long a worker waits for the hub at startup, for a publish to be acknowledged, and
+# between reconnect attempts.
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = 10
+RECONNECT_DELAY = 1
+# Threads the hub handles workers' requests on. A request that waits (loading a cold group, an
+# fsync, a big media write) only holds up its own thread, not the rest of its worker's requests.
+HUB_THREADS = int(os.environ.get('CHAT_HUB_THREADS', 32))
+# Shared by the hub and its workers. Required when the hub listens beyond this host.
+BROKER_KEY = os.environ.get('CHAT_BROKER_KEY', '')
+
+class BrokerUnavailable(Exception):
+    """Raised when a message can't be published because the broker can't be reached."""
+
+class Broker:
+    """Sequences a chat's messages and delivers them to every worker sharing the chat.
+
+    Each worker process has one broker. `publish` assigns messages their per-group ids,
+    makes sure every worker applies them (through the store's apply_messages) and returns them.
+    """
+
+    def start(self):
+        """Loads the current chat state. Called once at startup."""
+        raise NotImplementedError
+
+    def publish(self, group, entries):
+        """Publishes a batch of (username, text, full) entries and returns the messages with their ids and timestamps.
+
+        `full` is an optional full-size image link.
+        """
+        raise NotImplementedError
+
+    def publish_media(self, digest, mime_type, data):
+        """Makes a media blob available to every worker before messages referencing it."""
+        raise NotImplementedError
+
+    def load(self, group):
+        """Loads a group's history into the store (see app.open_group)."""
+        raise NotImplementedError
+
+    def unload(self, group, history):
+        """Puts away the history of a group the store has just hibernated."""
+        raise NotImplementedError
+
+    def update_group(self, name, entry):
+        """Creates or changes (`entry`) or deletes (None) a group on every worker."""
+        raise NotImplementedError
+
+def parse_address(address):
+    """Returns (socket family, address) for 'host:port' or 'unix:/path'."""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+def send_frame(sock, header, payload=b''):
+    # The hub queues the store's Message objects as they are; they're encoded here, on the sender
+    # thread, rather than while it holds the store lock
+    data = json.dumps(header, separators=(',', ':'), default=lambda message: message.record()).encode()
+    sock.sendall(FRAME_HEADER.pack(len(data), len(payload)) + data + payload)
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+def read_frame(stream, max_size=None):
+    """Reads one (header, payload) frame; raises EOFError when the connection closes.
+
+    Raises ValueError for a frame bigger than `max_size`, if given.
+    """
+    header_size, payload_size = FRAME_HEADER.unpack(read_exactly(stream, FRAME_HEADER.size))
+    if max_size is not None and header_size + payload_size > max_size:
+        raise ValueError(f'frame of {header_size + payload_size} bytes')
+    header = json.loads(read_exactly(stream, header_size))
+    return header, read_exactly(stream, payload_size)
+
+def challenge_response(nonce):
+    return hmac.new(BROKER_KEY.encode(), nonce.encode(), hashlib.sha256).hexdigest()
+
+class SocketBroker(Broker):
+    """Worker side of a BrokerHub connection.
+
+    A background thread applies everything the hub sends to the local `store` (app.py),
+    and reconnects (reloading the hub's snapshot) if the connection drops.
+    """
+
+    def __init__(self, address, store):
+        self.address = address
+        self.store = store
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.pending = {}  # request id -> [done Event, reply]
+        self.pending_lock = threading.Lock()
+        self.next_request = 0
+        self.connected = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name='broker', daemon=True).start()
+        if not self.connected.wait(CONNECT_TIMEOUT):
+            print(f'warning: broker at {self.address} is not reachable yet; publishing will fail until it is')
+
+    def run(self):
+        family, address = parse_address(self.address)
+        while True:
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.connect(address)
+                stream = sock.makefile('rb')
+                sock.settimeout(CONNECT_TIMEOUT)
+                header, _ = read_frame(stream)
+                send_frame(sock, {'op': 'auth', 'mac': challenge_response(str(header.get('nonce')))})
+                sock.settimeout(None)
+                with self.send_lock:
+                    self.sock = sock
+                while True:
+                    self.handle(*read_frame(stream))
+            except (OSError, EOFError):
+                pass
+            self.connected.clear()
+            with self.send_lock:
+                self.sock = None
+            # Whatever was in flight will never be acknowledged
+            with self.pending_lock:
+                for done, _ in self.pending.values():
+                    done.set()
+            time.sleep(RECONNECT_DELAY)
+
+    def handle(self, header, payload):
+        op = header['op']
+        if op == 'snapshot':
+            self.store.apply_registry(header['registry'], header['groups'])
+            self.connected.set()
+        elif op == 'messages':
+            self.store.apply_messages(header['group'], header['messages'])
+        elif op == 'group':
+            self.store.apply_group(header['name'], header['entry'])
+        elif op == 'media':
+            self.store.keep_media(header['digest'], header['mime_type'], payload)
+        elif op == 'ack':
+            if 'snapshot' in header:
+                # A loaded group; applied here, in order with the messages that follow it
+                self.store.apply_snapshot(header['group'], header['snapshot'])
+            with self.pending_lock:
+                waiter = self.pending.get(header['req'])
+            if waiter:
+                waiter[1] = header
+                waiter[0].set()
+
+    def request(self, header, payload=b''):
+        """Sends a frame to the hub and waits for its acknowledgement."""
+        if not self.connected.is_set():
+            raise BrokerUnavailable(f'broker at {self.address} is not connected')
+        waiter = [threading.Event(), None]
+        with self.pending_lock:
+            self.next_request += 1
+            header['req'] = self.next_request
+            self.pending[header['req']] = waiter
+        try:
+            with self.send_lock:
+                if self.sock is None:
+                    raise OSError('not connected')
+                send_frame(self.sock, header, payload)
+            waiter[0].wait(REQUEST_TIMEOUT)
+        except OSError as e:
+            raise BrokerUnavailable(str(e))
+        finally:
+            with self.pending_lock:
+                self.pending.pop(header['req'], None)
+        reply = waiter[1]
+        if reply is None or 'error' in reply:
+            raise BrokerUnavailable(reply['error'] if reply else 'no reply from broker')
+        return reply
+
+    def publish(self, group, entries):
+        # The hub sends the messages themselves before the ack, so they're already applied locally
+        records = self.request({'op': 'post', 'group': group, 'entries': entries})['messages']
+        return [self.store.Message.from_record(record) for record in records]
+
+    def publish_media(self, digest, mime_type, data):
+        self.request({'op': 'media', 'digest': digest, 'mime_type': mime_type}, data)
+
+    def load(self, group):
+        self.request({'op': 'load', 'group': group})
+
+    def unload(self, group, history):
+        pass  # The hub has it
+
+    def update_group(self, name, entry):
+        # The hub sends the change to every worker (this one included) before the ack
+        self.request({'op': 'group', 'name': name, 'entry': entry})
+
+class BrokerHub:
+    """Serves the chat state of this process's store (app.py) to SocketBroker workers.
+
+    Every connection gets an outbox drained by its own sender thread. Messages are queued
+    onto the outboxes while the store lock is held, so every worker sees them in id order.
+    Requests are handled on a shared pool and may finish out of order; acks carry the request id.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.outboxes = set()
+        self.pool = ThreadPoolExecutor(max_workers=HUB_THREADS, thread_name_prefix='hub')
+        store.message_listeners.append(self.fan_out)
+        store.group_listeners.append(self.fan_out_group)
+
+    def fan_out(self, group, batch):
+        # Runs under store.store_lock
+        for outbox in self.outboxes:
+            outbox.put(({'op': 'messages', 'group': group, 'messages': batch}, b''))
+
+    def fan_out_group(self, name, entry):
+        # Runs under store.store_lock
+        for outbox in self.outboxes:
+            outbox.put(({'op': 'group', 'name': name, 'entry': entry}, b''))
+
+    def authenticate(self, sock, stream):
+        """True if the worker at the other end answers a fresh challenge with CHAT_BROKER_KEY."""
+        nonce = secrets.token_hex(16)
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            send_frame(sock, {'op': 'challenge', 'nonce': nonce})
+            # Nobody's vouched for the peer yet, so it doesn't get to make the hub read much
+            header, _ = read_frame(stream, max_size=1024)
+            sock.settimeout(None)
+        except (OSError, EOFError, ValueError):
+            return False
+        return (isinstance(header, dict) and header.get('op') == 'auth'
+                and hmac.compare_digest(str(header.get('mac')), challenge_response(nonce)))
+
+    def serve(self, sock):
+        stream = sock.makefile('rb')
+        if not self.authenticate(sock, stream):
+            print('warning: refused a worker that did not know CHAT_BROKER_KEY')
+            sock.close()
+            return
+        outbox = queue.SimpleQueue()
+        sender = threading.Thread(target=self.send_forever, args=(sock, outbox), daemon=True)
+        sender.start()
+        with self.store.store_lock:
+            # Snapshot and subscribe atomically, so no message falls between the two. Only loaded
+            # groups are sent; workers ask for the others when they need them ('load').
+            histories = {group: history.after(0, history.count) for group, history in self.store.messages.items()}
+            outbox.put(({'op': 'snapshot', 'registry': dict(self.store.groups), 'groups': histories}, b''))
+            self.outboxes.add(outbox)
+        try:
+            while True:
+                header, payload = read_frame(stream)
+                self.pool.submit(self.handle, header, payload, outbox)
+        except (OSError, EOFError):
+            pass
+        finally:
+            with self.store.store_lock:
+                self.outboxes.discard(outbox)
+            outbox.put(None)
+
+    def handle(self, header, payload, outbox):
+        """Applies a worker's request and queues the acknowledgement frame (with `error` if it failed)."""
+        ack = {'op': 'ack', 'req': header.get('req')}
+        try:
+            self.apply(header, payload, outbox, ack)
+        except Exception as e:
+            # The worker's request failed, not its connection
+            outbox.put((dict(ack, error=f'{type(e).__name__}: {e}'), b''))
+
+    def apply(self, header, payload, outbox, ack):
+        if header['op'] in ('post', 'load') and not self.store.open_group(header['group']):
+            outbox.put((dict(ack, error='Invalid group'), b''))
+            return
+        if header['op'] == 'post':
+            # Posts from different workers are coalesced by the store's ingest queue, too
+            stored = self.store.append_messages(header['group'], [tuple(entry) for entry in header['entries']])
+            ack['messages'] = stored
+        elif header['op'] == 'load':
+            with self.store.store_lock:
+                history = self.store.messages[header['group']]
+                ack.update(group=header['group'], snapshot=history.after(0, history.count))
+                # Queued under the lock, so the worker gets every later message of the group after it
+                outbox.put((ack, b''))
+            return
+        elif header['op'] == 'group':
+            self.store.broker.update_group(header['name'], header['entry'])
+        elif header['op'] == 'media':
+            digest = self.store.store_media(payload, header['mime_type'])
+            media_frame = {'op': 'media', 'digest': digest, 'mime_type': header['mime_type']}
+            with self.store.store_lock:
+                for other in self.outboxes:
+                    other.put((media_frame, payload))
+        else:
+            raise ValueError(f"unknown op {header['op']!r}")
+        outbox.put((ack, b''))
+
+    def send_forever(self, sock, outbox):
+        try:
+            while (item := outbox.get()) is not None:
+                send_frame(sock, *item)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the message hub shared by several chat workers.')
+    parser.add_argument('--listen', default='127.0.0.1:6000', help="'host:port' or 'unix:/path/to/socket'")
+    args = parser.parse_args()
+
+    # The hub holds the real chat state, so it must not try to connect to a broker itself
+    os.environ.pop('CHAT_BROKER', None)
+    import app as store
+
+    hub = BrokerHub(store)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            hub.serve(self.request)
+
+    family, address = parse_address(args.listen)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = socketserver.ThreadingUnixStreamServer(address, Handler)
+    else:
+        if address[0] not in ('127.0.0.1', '::1', 'localhost') and not BROKER_KEY:
+            parser.error('set CHAT_BROKER_KEY (on the hub and every worker) to listen beyond this host')
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer(address, Handler)
+    server.daemon_threads = True
+    print(f'broker listening on {args.listen}')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
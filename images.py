@@ -0,0 +1,55 @@
+# images.py
+# Upload processing for app.upload_image. It runs in a process pool, so decoding and
+# resizing never hold up request threads (or the GIL), and the pool's processes only
+# need to import this small module.
+# Requires Pillow; without it uploads are stored exactly as sent.
+
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional
+    Image = None
+
+# Longest side, in pixels, of the thumbnail shown in the chat and of the full-size version
+THUMBNAIL_SIZE = 320
+DISPLAY_SIZE = 1280
+# Anything bigger is refused from its header, before it's decoded (decompression bombs)
+MAX_IMAGE_PIXELS = 50_000_000
+
+OUTPUT_FORMAT = 'WEBP'
+OUTPUT_MIME_TYPE = 'image/webp'
+
+def resized(img, size):
+    copy = img.copy()
+    copy.thumbnail((size, size), Image.LANCZOS)
+    out = io.BytesIO()
+    # Nothing from the original's info (EXIF, GPS, ICC, comments) is passed on
+    copy.save(out, OUTPUT_FORMAT, quality=80, method=4)
+    return out.getvalue()
+
+def process_image(data, mime_type):
+    """Returns [(thumbnail, mime type), (full-size version, mime type)] for an uploaded image.
+
+    Images are turned upright using their EXIF orientation, capped to DISPLAY_SIZE and
+    re-encoded without metadata. Animated images keep their original bytes as the full
+    version, with a still thumbnail. Raises ValueError if the data isn't a decodable image.
+    """
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # Pillow only refuses images over twice its limit (it just warns below that)
+            width, height = img.size
+            if width * height > MAX_IMAGE_PIXELS:
+                raise ValueError(f'Image is too large ({width}x{height} pixels)')
+            animated = getattr(img, 'is_animated', False)
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'RGBA'):
+                has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+                img = img.convert('RGBA' if has_alpha else 'RGB')
+            thumbnail = (resized(img, THUMBNAIL_SIZE), OUTPUT_MIME_TYPE)
+            if animated:
+                return [thumbnail, (data, mime_type)]
+            return [thumbnail, (resized(img, DISPLAY_SIZE), OUTPUT_MIME_TYPE)]
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f'Unsupported or corrupt image: {e}')
@@ -0,0 +1,105 @@
+# metrics.py
+# In-process metrics for app.py, exposed at /metrics in the Prometheus text format.
+# - Counters and histograms with labels, updated from any thread.
+# - `timed(section)` wraps known hot spots (bcrypt, serialization, compression, appends).
+# - Gauges are read at scrape time by callbacks the app registers (see gauge()).
+# Every worker process keeps its own numbers; scrape each one.
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cached poll (well under 1 ms) up to a long-poll
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+lock = threading.Lock()
+counters = {}    # name -> (help, {labels: value})
+histograms = {}  # name -> (help, {labels: [bucket counts..., sum, count]})
+gauges = {}      # name -> (help, callback returning {labels: value})
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, help_text, amount=1, **labels):
+    """Adds `amount` to a counter."""
+    with lock:
+        _, values = counters.setdefault(name, (help_text, {}))
+        key = labels_key(labels)
+        values[key] = values.get(key, 0) + amount
+
+def observe(name, help_text, seconds, **labels):
+    """Records one duration in a histogram."""
+    with lock:
+        _, values = histograms.setdefault(name, (help_text, {}))
+        row = values.setdefault(labels_key(labels), [0] * (len(BUCKETS) + 2))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                row[i] += 1
+        row[-2] += seconds
+        row[-1] += 1
+
+@contextmanager
+def timed(section):
+    """Times the enclosed block into chat_section_duration_seconds{section=...}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('chat_section_duration_seconds', 'Time spent in hot code sections', time.perf_counter() - start, section=section)
+
+def gauge(name, help_text, callback):
+    """Registers a gauge whose values ({labels tuple: value}) are read by calling `callback` at scrape time."""
+    gauges[name] = (help_text, callback)
+
+class Tracker:
+    """A gauge of things currently in progress (e.g. open streams), kept with inc/dec."""
+
+    def __init__(self, name, help_text):
+        self.values = {}
+        gauge(name, help_text, lambda: dict(self.values))
+
+    def inc(self, **labels):
+        with lock:
+            key = labels_key(labels)
+            self.values[key] = self.values.get(key, 0) + 1
+
+    def dec(self, **labels):
+        with lock:
+            key = labels_key(labels)
+            self.values[key] = self.values.get(key, 0) - 1
+
+    @contextmanager
+    def tracking(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def render():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    with lock:
+        for name, (help_text, values) in sorted(counters.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [f'{name}{format_labels(key)} {value}' for key, value in sorted(values.items())]
+        for name, (help_text, values) in sorted(histograms.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            for key, row in sorted(values.items()):
+                for bound, count in zip(BUCKETS, row):
+                    lines.append(f'{name}_bucket{format_labels(key, [("le", bound)])} {count}')
+                lines.append(f'{name}_bucket{format_labels(key, [("le", "+Inf")])} {row[-1]}')
+                lines.append(f'{name}_sum{format_labels(key)} {row[-2]:.6f}')
+                lines.append(f'{name}_count{format_labels(key)} {row[-1]}')
+    # Gauge callbacks may take other locks (app.store_lock), so they run outside ours
+    for name, (help_text, callback) in sorted(gauges.items()):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+        lines += [f'{name}{format_labels(key)} {value}' for key, value in sorted(callback().items())]
+    return '\n'.join(lines) + '\n'
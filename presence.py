@@ -0,0 +1,129 @@
+# presence.py
+# Who's online in each group and who's typing, for app.py. Entries expire unless the client
+# refreshes them (by polling, keeping a stream open or typing). They're filed in one-second
+# buckets by deadline, so a sweep only visits the buckets that are due: O(expired), not
+# O(everyone). Not thread-safe on its own; app.py calls it with store_lock held.
+
+import time
+
+BUCKET_SECONDS = 1
+# Longer names aren't tracked (usernames are whatever the client says)
+MAX_NAME_LENGTH = 64
+
+class ExpiringSet:
+    """Keys with deadlines. expire(now) removes and returns the keys whose deadline has passed."""
+
+    def __init__(self):
+        self.deadlines = {}
+        self.buckets = {}  # bucket number -> keys with a deadline in that second
+        self.swept = None  # every bucket up to this one has been expired
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def touch(self, key, deadline):
+        """Adds `key` or moves its deadline. Returns True if it's new."""
+        previous = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        bucket = int(deadline // BUCKET_SECONDS)
+        if previous is not None:
+            old = int(previous // BUCKET_SECONDS)
+            if old == bucket:
+                return False
+            self.buckets[old].discard(key)
+        self.buckets.setdefault(bucket, set()).add(key)
+        return previous is None
+
+    def discard(self, key):
+        """Removes `key`. Returns True if it was there."""
+        deadline = self.deadlines.pop(key, None)
+        if deadline is None:
+            return False
+        self.buckets[int(deadline // BUCKET_SECONDS)].discard(key)
+        return True
+
+    def expire(self, now):
+        # Only whole seconds that are over; a key can outlive its deadline by up to a second
+        due = int(now // BUCKET_SECONDS)
+        start = self.swept + 1 if self.swept is not None else None
+        if start is None or due - start > len(self.buckets):
+            # First sweep, or idle for longer than there are buckets: visit the buckets instead of the seconds
+            numbers = sorted(b for b in self.buckets if b < due)
+        else:
+            numbers = range(start, due)
+        self.swept = due - 1
+        expired = []
+        for number in numbers:
+            for key in self.buckets.pop(number, ()):
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+class Presence:
+    """Online and typing users per group.
+
+    Each group has a version that changes whenever its summary does (someone joins, leaves,
+    starts or stops typing), so responses that include the summary can be cached per version.
+    """
+
+    def __init__(self, ttl, typing_ttl):
+        self.ttl = ttl
+        self.typing_ttl = typing_ttl
+        self.online = ExpiringSet()  # (group, username)
+        self.typing = ExpiringSet()
+        self.members = {}            # group -> usernames online
+        self.typers = {}             # group -> usernames typing
+        self.versions = {}
+
+    def version(self, group):
+        return self.versions.get(group, 0)
+
+    def changed(self, group):
+        self.versions[group] = self.version(group) + 1
+
+    def seen(self, group, username, typing=None, now=None):
+        """Marks `username` as online in `group`; `typing` True/False starts/stops typing.
+
+        Returns True if the group's summary changed.
+        """
+        if not isinstance(username, str) or not 0 < len(username) <= MAX_NAME_LENGTH:
+            return False
+        now = time.monotonic() if now is None else now
+        key = (group, username)
+        changed = False
+        if self.online.touch(key, now + self.ttl):
+            self.members.setdefault(group, set()).add(username)
+            changed = True
+        if typing:
+            if self.typing.touch(key, now + self.typing_ttl):
+                self.typers.setdefault(group, set()).add(username)
+                changed = True
+        elif typing is not None and self.typing.discard(key):
+            self.typers[group].discard(username)
+            changed = True
+        if changed:
+            self.changed(group)
+        return changed
+
+    def expire(self, now=None):
+        """Drops everyone whose entries ran out. Returns the groups whose summary changed."""
+        now = time.monotonic() if now is None else now
+        groups = set()
+        for group, username in self.online.expire(now):
+            self.members[group].discard(username)
+            # Leaving also stops typing
+            if self.typing.discard((group, username)):
+                self.typers[group].discard(username)
+            groups.add(group)
+        for group, username in self.typing.expire(now):
+            self.typers[group].discard(username)
+            groups.add(group)
+        for group in groups:
+            self.changed(group)
+        return groups
+
+    def summary(self, group):
+        return {
+            'online': sorted(self.members.get(group, ())),
+            'typing': sorted(self.typers.get(group, ()))
+        }
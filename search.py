@@ -0,0 +1,82 @@
+# search.py
+# Inverted index over a group's message texts, kept in step with app.MessageHistory: messages
+# are indexed as they're appended and dropped as they're evicted, so the index never holds
+# more than the history does. Media messages (uploads, GIF links) aren't indexed.
+
+import re
+from bisect import bisect_left, insort
+from collections import deque
+
+TOKEN_RE = re.compile(r'\w+')
+# Longer "words" (pasted hashes, base64...) are cut to this many characters
+MAX_TOKEN_LENGTH = 32
+
+def is_media(text):
+    """Same test the frontend uses to show a message as an image."""
+    return (text.startswith('data:image') or text.startswith('https://media.tenor.com/') or '/media/' in text
+            or text.endswith('.gif') or 'tenor.googleapis.com' in text)
+
+def tokenize(text):
+    """The distinct lower-case words of a text."""
+    return {token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall(text.lower())}
+
+def message_tokens(message):
+    text = message.text
+    if not isinstance(text, str) or is_media(text):
+        return ()
+    return tokenize(text)
+
+class SearchIndex:
+    """Maps each word to the ids of the messages containing it, in id order.
+
+    Messages are added newest-last and removed oldest-first (like the ring buffer they
+    mirror), so a removed id is always at the front of its posting lists. The sorted word
+    list answers prefix queries with a binary search.
+    """
+
+    def __init__(self):
+        self.postings = {}  # word -> deque of message ids
+        self.words = []     # sorted
+
+    def add(self, message):
+        for token in message_tokens(message):
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = deque()
+                insort(self.words, token)
+            ids.append(message.id)
+
+    def remove_oldest(self, message):
+        for token in message_tokens(message):
+            ids = self.postings.get(token)
+            if ids and ids[0] == message.id:
+                ids.popleft()
+                if not ids:
+                    del self.postings[token]
+                    del self.words[bisect_left(self.words, token)]
+
+    def clear(self):
+        self.postings = {}
+        self.words = []
+
+    def prefix_ids(self, prefix):
+        """Ids of messages containing a word that starts with `prefix`."""
+        ids = set()
+        i = bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            ids.update(self.postings[self.words[i]])
+            i += 1
+        return ids
+
+    def search(self, query, before, limit):
+        """Ids of messages older than `before` containing every word of `query` (as a prefix), newest first."""
+        terms = sorted(tokenize(query), key=len, reverse=True)
+        if not terms:
+            return []
+        # Longest (most selective) terms first, so the candidate set shrinks fast
+        matches = self.prefix_ids(terms[0])
+        for term in terms[1:]:
+            if not matches:
+                break
+            matches &= self.prefix_ids(term)
+        return sorted((i for i in matches if i < before), reverse=True)[:limit]
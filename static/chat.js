@@ -0,0 +1,793 @@
+// chat.js
+// Frontend for app.py. Served from /static/ under a fingerprinted URL (see app.static_assets).
+
+// --- Tenor API Configuration ---
+const TENOR_API_KEY = ""; 
+const TENOR_CLIENT_KEY = "my-local-chat-app"; 
+
+// Group names, injected by the server into <body data-groups>
+const GROUPS = JSON.parse(document.body.dataset.groups);
+
+// DOM Elements
+const loginScreen = document.getElementById('login-screen');
+const groupScreen = document.getElementById('group-screen');
+const chatScreen = document.getElementById('chat-screen');
+
+const loginForm = document.getElementById('login-form');
+const usernameInput = document.getElementById('username-input');
+const welcomeMessage = document.getElementById('welcome-message');
+const currentGroupLabel = document.getElementById('current-group');
+const presenceLabel = document.getElementById('presence');
+
+const groupForm = document.getElementById('group-form');
+const groupSelect = document.getElementById('group-select');
+const groupPassInput = document.getElementById('group-pass-input');
+const cancelToLogin = document.getElementById('cancel-to-login');
+const leaveGroupBtn = document.getElementById('leave-group-btn');
+
+const messagesContainer = document.getElementById('messages');
+const messageForm = document.getElementById('message-form');
+const messageInput = document.getElementById('message-input');
+
+const emojiBtn = document.getElementById('emoji-btn');
+const emojiPickerContainer = document.getElementById('emoji-picker-container');
+// emoji-picker-element is loaded from its CDN on first use; offline, a built-in set is shown instead
+const EMOJI_PICKER_URL = 'https://cdn.jsdelivr.net/npm/emoji-picker-element@^1/index.js';
+const FALLBACK_EMOJIS = ['😀', '😂', '🤣', '😊', '😍', '😘', '😎', '🤔', '😅', '😭', '😡', '😱', '🥳', '😴', '🙄', '😬',
+    '👍', '👎', '👏', '🙏', '💪', '👋', '🤝', '✌️', '❤️', '💔', '🔥', '✨', '🎉', '💯', '✅', '❌',
+    '😢', '🤗', '🤩', '😇', '🙃', '😉', '😜', '🤯', '👀', '🍕', '🍺', '☕', '⚽', '🎮', '🚀', '🌈'];
+let emojiPickerLoaded = false;
+
+const gifBtn = document.getElementById('gif-btn');
+const gifModal = document.getElementById('gif-modal');
+const gifModalClose = document.getElementById('gif-modal-close');
+const gifSearchInput = document.getElementById('gif-search-input');
+const gifResults = document.getElementById('gif-results');
+
+// --- NEW: Image upload elements ---
+const imageUpload = document.getElementById('image-upload');
+const imagePreviewContainer = document.getElementById('image-preview-container');
+const imagePreview = document.getElementById('image-preview');
+const cancelImage = document.getElementById('cancel-image');
+let selectedFile = null;
+
+let username = '';
+let currentGroup = '';
+let sessionToken = '';
+let lastMessageId = 0;
+let chatStream = null;
+let chatSocket = null;
+// Set once a socket has opened, so a refused one later means trouble rather than no /ws here
+let socketsWork = false;
+// Messages sent over the WebSocket and not acked yet, by ref
+const pendingSends = new Map();
+let nextSendRef = 0;
+// Every post carries a key made of this and its ref, so one that's resent over HTTP after a dropped
+// socket (it may have arrived; only its ack was lost) isn't stored twice
+const clientId = Array.from(crypto.getRandomValues(new Uint8Array(8)), b => b.toString(16).padStart(2, '0')).join('');
+// We tell the group we're typing at most this often (the server shows it for a few seconds)
+const TYPING_INTERVAL = 3000;
+let lastTypingSent = 0;
+
+// #messages shows a window of at most MAX_RENDERED messages. Older pages load when the
+// user scrolls to the top; nodes scrolled far out of view are dropped (and reused).
+const PAGE_SIZE = 50;
+const MAX_RENDERED = 200;
+let oldestRendered = 0;
+let newestRendered = 0;
+let hasOlder = false;
+let loadingPage = false;
+const recycledNodes = [];
+// Messages received in this group, by id (ids are consecutive), so scrolling back over them
+// re-renders them from memory instead of fetching them again. The least recently used go first.
+const MAX_KEPT = 1000;
+const keptMessages = new Map();
+
+// Hidden tabs stop receiving after a while (no socket, stream or poll held open for them) and
+// catch up from lastMessageId when they're shown again.
+const HIDDEN_PAUSE_DELAY = 30000;
+let pausedWhileHidden = false;
+
+function populateGroups() {
+    groupSelect.innerHTML = '';
+    GROUPS.forEach(g => {
+        const opt = document.createElement('option');
+        opt.value = g;
+        opt.textContent = g;
+        groupSelect.appendChild(opt);
+    });
+}
+populateGroups();
+
+// --- Event Listeners ---
+loginForm.addEventListener('submit', (event) => {
+    event.preventDefault();
+    const enteredUsername = usernameInput.value.trim();
+    if (enteredUsername) {
+        username = enteredUsername;
+        welcomeMessage.textContent = `Welcome, ${username}!`;
+        loginScreen.classList.add('hidden');
+        groupScreen.classList.remove('hidden');
+    }
+});
+
+cancelToLogin.addEventListener('click', () => {
+    groupScreen.classList.add('hidden');
+    loginScreen.classList.remove('hidden');
+});
+
+leaveGroupBtn.addEventListener('click', leaveGroup);
+
+function leaveGroup() {
+    stopReceiving();
+    pausedWhileHidden = false;
+    currentGroup = '';
+    sessionToken = '';
+    groupPassInput.value = '';
+    chatScreen.classList.add('hidden');
+    chatScreen.classList.remove('flex');
+    groupScreen.classList.remove('hidden');
+}
+
+// The server turned our token down (401): it restarted with a new key, the session expired or
+// the group's password changed. Back to the group screen to join again.
+function endSession() {
+    if (!currentGroup) return;
+    leaveGroup();
+    alert('Your session has ended. Please join the group again.');
+}
+
+// A stream or socket the server refused may mean our session has ended. A tiny poll finds out
+// (fetchPage ends the session on a 401). Resolves true if we're still in `group` and should reconnect.
+async function checkSession(group) {
+    try {
+        await fetchPage(`since=${lastMessageId}&limit=1`);
+    } catch (error) {
+        console.error('Session check failed:', error);
+    }
+    return group === currentGroup && !pausedWhileHidden;
+}
+
+groupForm.addEventListener('submit', async (e) => {
+    e.preventDefault();
+    const selectedGroup = groupSelect.value;
+    const password = groupPassInput.value;
+    if (!selectedGroup) {
+        alert('Please select a group.');
+        return;
+    }
+    try {
+        const res = await fetch(`/check_group?name=${encodeURIComponent(selectedGroup)}&password=${encodeURIComponent(password)}`);
+        if (!res.ok) throw new Error('Invalid group or password');
+        const data = await res.json();
+        if (data.status === 'success') {
+            currentGroup = selectedGroup;
+            sessionToken = data.token;
+            currentGroupLabel.textContent = `Group: ${currentGroup}`;
+            groupScreen.classList.add('hidden');
+            chatScreen.classList.remove('hidden');
+            chatScreen.classList.add('flex');
+            initializeChat();
+        } else {
+            alert('Invalid group or password');
+        }
+    } catch (err) {
+        alert('Invalid group or password');
+        console.error('Group join error:', err);
+    }
+});
+
+// --- NEW: Image handling event listeners ---
+imageUpload.addEventListener('change', (event) => {
+    const file = event.target.files[0];
+    if (file) {
+        selectedFile = file;
+        const reader = new FileReader();
+        reader.onload = (e) => {
+            imagePreview.src = e.target.result;
+            imagePreviewContainer.classList.remove('hidden');
+            messageInput.placeholder = "Image selected. Press send.";
+            messageInput.disabled = true; 
+        };
+        reader.readAsDataURL(file);
+    }
+});
+
+cancelImage.addEventListener('click', () => {
+    selectedFile = null;
+    imageUpload.value = ''; // Clear the file input
+    imagePreviewContainer.classList.add('hidden');
+    messageInput.placeholder = "Type your message...";
+    messageInput.disabled = false;
+});
+
+
+// --- Chat Logic ---
+function initializeChat() {
+    messageForm.onsubmit = handleFormSubmit;
+    emojiBtn.onclick = toggleEmoji;
+    gifBtn.onclick = openGifModal;
+    gifModalClose.onclick = () => gifModal.classList.add('hidden');
+    gifSearchInput.onkeyup = onGifSearchKey;
+    messageInput.oninput = notifyTyping;
+    
+    messagesContainer.onscroll = onMessagesScroll;
+
+    stopReceiving();
+    pausedWhileHidden = false;
+    messagesContainer.innerHTML = '';
+    keptMessages.clear();
+    presenceLabel.textContent = '';
+    lastMessageId = 0;
+    oldestRendered = 0;
+    newestRendered = 0;
+    hasOlder = false;
+    loadLatest().then(() => {
+        scrollToBottom();
+        startReceiving();
+    });
+}
+
+// Prefer the WebSocket (push and send on one connection), then SSE, then polling.
+function startReceiving() {
+    if (!currentGroup) return;
+    if (window.WebSocket) {
+        openSocket();
+    } else {
+        startStream();
+    }
+}
+
+function startStream() {
+    if (window.EventSource) {
+        chatStream = new EventSource(`/stream?group=${encodeURIComponent(currentGroup)}&since=${lastMessageId}&token=${encodeURIComponent(sessionToken)}&username=${encodeURIComponent(username)}`);
+        chatStream.onmessage = (event) => appendMessages(JSON.parse(event.data));
+        chatStream.addEventListener('presence', (event) => showPresence(JSON.parse(event.data)));
+        chatStream.onerror = () => {
+            // EventSource retries dropped connections itself; it gives up on a refused one (e.g. 401)
+            if (!chatStream || chatStream.readyState !== EventSource.CLOSED) return;
+            const group = currentGroup;
+            chatStream = null;
+            checkSession(group).then(valid => {
+                if (valid) window._chatReconnect = setTimeout(startReceiving, 1000);
+            });
+        };
+    } else {
+        window._chatPoller = setInterval(fetchMessages, 2000);
+    }
+}
+
+function openSocket() {
+    const group = currentGroup;
+    const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+    const socket = new WebSocket(`${scheme}://${location.host}/ws?group=${encodeURIComponent(group)}&since=${lastMessageId}&token=${encodeURIComponent(sessionToken)}&username=${encodeURIComponent(username)}&compact=1`);
+    let opened = false;
+    socket.onopen = () => {
+        opened = true;
+        socketsWork = true;
+    };
+    socket.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.presence) showPresence(data.presence);
+        if (data.messages) {
+            appendMessages(decodeMessages(data));
+            return;
+        }
+        if (data.presence) return;
+        if (data.ref !== undefined) pendingSends.delete(data.ref);
+        if (data.status === 'error') console.error('Failed to send message:', data.message);
+    };
+    socket.onclose = (event) => {
+        if (chatSocket !== socket) return; // Closed by stopReceiving
+        chatSocket = null;
+        if (event.code === 1008) {
+            // The server ended our session (the group's password changed, or the token expired)
+            endSession();
+            return;
+        }
+        // Unacked messages may not have arrived; send them again over HTTP
+        const unacked = [...pendingSends.values()];
+        pendingSends.clear();
+        unacked.forEach(postMessage);
+        if (!opened) {
+            // Refused: our session has ended, or there's no /ws on this server (e.g. the dev server)
+            checkSession(group).then(valid => {
+                if (!valid) return;
+                if (!socketsWork) {
+                    startStream();
+                    return;
+                }
+                window._chatReconnect = setTimeout(() => {
+                    if (group === currentGroup && !chatSocket) openSocket();
+                }, 1000);
+            });
+            return;
+        }
+        // Dropped, or closed because we fell behind: resume from our cursor
+        window._chatReconnect = setTimeout(() => {
+            if (group === currentGroup && !chatSocket) openSocket();
+        }, 1000);
+    };
+    chatSocket = socket;
+}
+
+function stopReceiving() {
+    if (chatSocket) {
+        const socket = chatSocket;
+        chatSocket = null;
+        socket.close();
+    }
+    pendingSends.clear();
+    if (window._chatReconnect) clearTimeout(window._chatReconnect);
+    if (chatStream) {
+        chatStream.close();
+        chatStream = null;
+    }
+    if (window._chatPoller) clearInterval(window._chatPoller);
+}
+
+document.addEventListener('visibilitychange', () => {
+    clearTimeout(window._chatPause);
+    if (document.hidden) {
+        window._chatPause = setTimeout(pauseReceiving, HIDDEN_PAUSE_DELAY);
+    } else if (pausedWhileHidden) {
+        pausedWhileHidden = false;
+        startReceiving();
+    }
+});
+
+function pauseReceiving() {
+    if (!currentGroup || !document.hidden) return;
+    // Like a dropped socket: whatever wasn't acked yet goes over HTTP
+    const unacked = [...pendingSends.values()];
+    stopReceiving();
+    unacked.forEach(postMessage);
+    pausedWhileHidden = true;
+}
+
+function toggleEmoji() {
+    emojiPickerContainer.classList.toggle('hidden');
+    if (!emojiPickerLoaded) loadEmojiPicker();
+}
+
+async function loadEmojiPicker() {
+    emojiPickerLoaded = true;
+    try {
+        await import(EMOJI_PICKER_URL);
+        const picker = document.createElement('emoji-picker');
+        picker.className = 'dark';
+        picker.addEventListener('emoji-click', event => insertEmoji(event.detail.unicode));
+        emojiPickerContainer.appendChild(picker);
+    } catch (error) {
+        const grid = document.createElement('div');
+        grid.className = 'emoji-grid';
+        FALLBACK_EMOJIS.forEach(emoji => {
+            const button = document.createElement('button');
+            button.type = 'button';
+            button.textContent = emoji;
+            button.onclick = () => insertEmoji(emoji);
+            grid.appendChild(button);
+        });
+        emojiPickerContainer.appendChild(grid);
+    }
+}
+
+function insertEmoji(emoji) {
+    messageInput.value += emoji;
+}
+
+function onGifSearchKey(event) {
+    if (event.key === 'Enter') searchGifs();
+}
+
+function scrollToBottom() {
+    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+}
+
+// --- Message Rendering ---
+function isMediaUrl(text) {
+    return text.startsWith('data:image') || text.startsWith('https://media.tenor.com/') || text.includes('/media/') || text.endsWith('.gif') || text.includes('tenor.googleapis.com');
+}
+
+// Builds a bubble from DOM nodes (text goes in as textContent, never as markup).
+function renderMessage(msg) {
+    const messageElement = recycledNodes.pop() || document.createElement('div');
+    const isCurrentUser = msg.username === username;
+    messageElement.className = `flex flex-col ${isCurrentUser ? 'items-end' : 'items-start'}`;
+    messageElement.dataset.id = msg.id;
+
+    const bubble = createElement('div', `max-w-xs md:max-w-md p-3 rounded-xl ${isCurrentUser ? 'bg-blue-600 text-white rounded-br-none' : 'bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded-bl-none'}`);
+    const header = createElement('div', 'flex items-baseline space-x-2');
+    header.append(
+        createElement('p', `font-semibold text-sm ${isCurrentUser ? 'text-blue-200' : 'text-gray-500'}`, isCurrentUser ? 'You' : msg.username),
+        createElement('p', `text-xs ${isCurrentUser ? 'text-blue-300' : 'text-gray-400'}`, msg.timestamp)
+    );
+    bubble.append(header, renderContent(msg));
+    messageElement.replaceChildren(bubble);
+    return messageElement;
+}
+
+function renderContent(msg) {
+    if (!isMediaUrl(msg.text)) return createElement('p', 'text-md break-words', msg.text);
+    const img = createElement('img', 'mt-1 rounded-lg max-w-full h-auto');
+    img.src = msg.text;
+    img.alt = 'Chat content';
+    img.loading = 'lazy';
+    img.decoding = 'async';
+    img.style.maxHeight = '250px';
+    if (!msg.full) return img;
+    // Uploaded images show a thumbnail that opens the full-size version
+    const link = document.createElement('a');
+    link.href = msg.full;
+    link.target = '_blank';
+    link.rel = 'noopener';
+    link.appendChild(img);
+    return link;
+}
+
+function createElement(tag, className, text) {
+    const element = document.createElement(tag);
+    element.className = className;
+    if (text !== undefined) element.textContent = text;
+    return element;
+}
+
+function keepMessage(msg) {
+    keptMessages.delete(msg.id);
+    keptMessages.set(msg.id, msg);
+    if (keptMessages.size > MAX_KEPT) keptMessages.delete(keptMessages.keys().next().value);
+}
+
+// The kept messages `first` to `last` (inclusive), or null if any of them isn't kept.
+function keptRange(first, last) {
+    const range = [];
+    for (let id = first; id <= last; id++) {
+        const msg = keptMessages.get(id);
+        if (!msg) return null;
+        range.push(msg);
+    }
+    return range;
+}
+
+// Live messages from the stream or the poller.
+function appendMessages(messages) {
+    const isScrolledToBottom = messagesContainer.scrollHeight - messagesContainer.clientHeight <= messagesContainer.scrollTop + 1;
+    // Scrolled back through history: newer messages load when the user scrolls down again
+    const showingNewest = newestRendered >= lastMessageId;
+
+    messages.forEach(msg => {
+        // Overlapping polls (or a poll racing the stream) can return the same delta twice
+        if (msg.id <= lastMessageId) return;
+        lastMessageId = msg.id;
+        keepMessage(msg);
+        if (!showingNewest) return;
+        messagesContainer.appendChild(renderMessage(msg));
+        newestRendered = msg.id;
+        if (!oldestRendered) oldestRendered = msg.id;
+    });
+
+    if (isScrolledToBottom) {
+        trimTop();
+        scrollToBottom();
+    } else {
+        trimBottom();
+    }
+}
+
+function removeRendered(element) {
+    element.remove();
+    if (recycledNodes.length < PAGE_SIZE) recycledNodes.push(element);
+}
+
+function trimTop() {
+    if (messagesContainer.children.length <= MAX_RENDERED) return;
+    while (messagesContainer.children.length > MAX_RENDERED) removeRendered(messagesContainer.firstElementChild);
+    oldestRendered = Number(messagesContainer.firstElementChild.dataset.id);
+    hasOlder = true;
+}
+
+function trimBottom() {
+    if (messagesContainer.children.length <= MAX_RENDERED) return;
+    while (messagesContainer.children.length > MAX_RENDERED) removeRendered(messagesContainer.lastElementChild);
+    newestRendered = Number(messagesContainer.lastElementChild.dataset.id);
+}
+
+// Keeps the message at the top of the view in place while nodes are added or removed around it.
+function keepScrollPosition(change) {
+    const viewTop = messagesContainer.getBoundingClientRect().top;
+    const anchor = Array.from(messagesContainer.children).find(el => el.getBoundingClientRect().bottom > viewTop);
+    const anchorTop = anchor ? anchor.getBoundingClientRect().top : 0;
+    change();
+    if (anchor && anchor.isConnected) messagesContainer.scrollTop += anchor.getBoundingClientRect().top - anchorTop;
+}
+
+function onMessagesScroll() {
+    const fromBottom = messagesContainer.scrollHeight - messagesContainer.clientHeight - messagesContainer.scrollTop;
+    if (messagesContainer.scrollTop < 100) loadOlder();
+    else if (fromBottom < 100) loadNewer();
+}
+
+// Pages are requested in the compact format: each message is a row of `fields` values instead of
+// an object repeating every key. Turns them back into objects.
+const COMPACT_TYPE = 'application/vnd.chat.compact+json';
+
+function decodeMessages(page) {
+    if (!page.fields) return page.messages;
+    return page.messages.map(row => {
+        const msg = {};
+        row.forEach((value, i) => { msg[page.fields[i]] = value; });
+        return msg;
+    });
+}
+
+async function fetchPage(params) {
+    const group = currentGroup;
+    const response = await fetch(`/messages?group=${encodeURIComponent(group)}&username=${encodeURIComponent(username)}&${params}`, {
+        headers: { 'Authorization': `Bearer ${sessionToken}`, 'Accept': COMPACT_TYPE }
+    });
+    if (response.status === 401 && group === currentGroup) endSession();
+    if (!response.ok) throw new Error('Network response was not ok');
+    const data = await response.json();
+    data.messages = decodeMessages(data);
+    if (data.presence && group === currentGroup) showPresence(data.presence);
+    return data;
+}
+
+// --- Presence ---
+// Who's online and typing comes along with message pages, stream events and socket frames.
+function showPresence(presence) {
+    const typing = presence.typing.filter(name => name !== username);
+    let text = `${presence.online.length} online: ${presence.online.join(', ')}`;
+    if (typing.length) text += ` · ${typing.join(', ')} ${typing.length === 1 ? 'is' : 'are'} typing…`;
+    presenceLabel.textContent = text;
+}
+
+function notifyTyping() {
+    if (!currentGroup || !messageInput.value || Date.now() - lastTypingSent < TYPING_INTERVAL) return;
+    lastTypingSent = Date.now();
+    if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+        chatSocket.send(JSON.stringify({ typing: true }));
+    } else {
+        // No socket to say it on: piggyback on a (tiny) poll
+        fetchPage(`since=${lastMessageId}&limit=1&typing=1`).catch(() => {});
+    }
+}
+
+// Joining only downloads the latest page; older ones are loaded on scroll.
+async function loadLatest() {
+    if (!currentGroup) return;
+    const group = currentGroup;
+    try {
+        const data = await fetchPage(`limit=${PAGE_SIZE}`);
+        if (group !== currentGroup) return;
+        appendMessages(data.messages);
+        lastMessageId = newestRendered = data.cursor;
+        oldestRendered = data.before;
+        hasOlder = data.older;
+    } catch (error) {
+        console.error('Failed to fetch messages:', error);
+    }
+}
+
+// Scrolling back over messages we still have re-renders them; otherwise the page is fetched.
+async function loadOlder() {
+    if (loadingPage || !hasOlder) return;
+    const first = Math.max(oldestRendered - PAGE_SIZE, 1);
+    const kept = keptRange(first, oldestRendered - 1);
+    if (kept && kept.length) {
+        showOlder(kept, first, first > 1);
+        return;
+    }
+    loadingPage = true;
+    const group = currentGroup;
+    try {
+        const data = await fetchPage(`before=${oldestRendered}&limit=${PAGE_SIZE}`);
+        if (group !== currentGroup) return;
+        data.messages.forEach(keepMessage);
+        showOlder(data.messages, data.before, data.older);
+    } catch (error) {
+        console.error('Failed to load older messages:', error);
+    } finally {
+        loadingPage = false;
+    }
+}
+
+function showOlder(page, before, older) {
+    keepScrollPosition(() => {
+        const fragment = document.createDocumentFragment();
+        page.forEach(msg => fragment.appendChild(renderMessage(msg)));
+        messagesContainer.prepend(fragment);
+        trimBottom();
+    });
+    oldestRendered = before;
+    hasOlder = older;
+}
+
+async function loadNewer() {
+    if (loadingPage || newestRendered >= lastMessageId) return;
+    const last = Math.min(newestRendered + PAGE_SIZE, lastMessageId);
+    const kept = keptRange(newestRendered + 1, last);
+    if (kept) {
+        showNewer(kept, last);
+        return;
+    }
+    loadingPage = true;
+    const group = currentGroup;
+    try {
+        const data = await fetchPage(`since=${newestRendered}&limit=${PAGE_SIZE}`);
+        if (group !== currentGroup) return;
+        data.messages.forEach(keepMessage);
+        showNewer(data.messages, data.cursor);
+        lastMessageId = Math.max(lastMessageId, newestRendered);
+    } catch (error) {
+        console.error('Failed to load newer messages:', error);
+    } finally {
+        loadingPage = false;
+    }
+}
+
+function showNewer(page, cursor) {
+    keepScrollPosition(() => {
+        const fragment = document.createDocumentFragment();
+        page.forEach(msg => fragment.appendChild(renderMessage(msg)));
+        messagesContainer.appendChild(fragment);
+        newestRendered = cursor;
+        trimTop();
+    });
+}
+
+// Poller fallback: asks only for messages after the last one we've received.
+async function fetchMessages() {
+    if (!currentGroup) return;
+    const group = currentGroup;
+    try {
+        let more = true;
+        while (more) {
+            const data = await fetchPage(`since=${lastMessageId}`);
+            if (group !== currentGroup) return; // Group changed while we were waiting
+            appendMessages(data.messages);
+            more = data.more;
+        }
+    } catch (error) {
+        console.error('Failed to fetch messages:', error);
+    }
+}
+
+// --- Message & Image Sending ---
+async function handleFormSubmit(event) {
+    event.preventDefault();
+    emojiPickerContainer.classList.add('hidden');
+
+    if (selectedFile) {
+        await sendImage(selectedFile);
+        // Reset after sending
+        cancelImage.click(); // Programmatically click cancel to reset UI
+    } else {
+        const text = messageInput.value.trim();
+        if (text !== '') {
+            sendMessage(text);
+            messageInput.value = '';
+        }
+    }
+}
+
+async function sendMessage(text) {
+    if (!currentGroup) {
+        alert('No group selected.');
+        return;
+    }
+    // Sending stops the typing indicator on the server
+    lastTypingSent = 0;
+    const ref = ++nextSendRef;
+    const send = { text: text, key: `${clientId}:${ref}` };
+    if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+        pendingSends.set(ref, send);
+        chatSocket.send(JSON.stringify({ username: username, text: text, ref: ref, key: send.key }));
+        scrollToBottom();
+        return;
+    }
+    await postMessage(send);
+}
+
+async function postMessage(send) {
+    const message = { username: username, text: send.text, key: send.key, group: currentGroup };
+    try {
+        const response = await fetch('/messages', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${sessionToken}` },
+            body: JSON.stringify(message)
+        });
+        if (response.ok) {
+            // The socket or stream delivers our own message too; only polling clients need to fetch
+            if (!chatStream && !chatSocket) await fetchMessages();
+            scrollToBottom();
+        } else if (response.status === 401) {
+            endSession();
+        } else {
+            console.error('Failed to send message');
+        }
+    } catch (error) {
+        console.error('Error sending message:', error);
+    }
+}
+
+// NEW: Function to upload the image file
+async function sendImage(file) {
+    const formData = new FormData();
+    formData.append('image', file);
+    formData.append('username', username);
+    formData.append('group', currentGroup);
+
+    try {
+        const response = await fetch('/upload_image', {
+            method: 'POST',
+            headers: { 'Authorization': `Bearer ${sessionToken}` },
+            body: formData
+        });
+        if (response.ok) {
+            if (!chatStream && !chatSocket) await fetchMessages();
+            scrollToBottom();
+        } else if (response.status === 401) {
+            endSession();
+        } else {
+            alert('Failed to upload image. Please try again.');
+            console.error('Failed to send image');
+        }
+    } catch (error) {
+        console.error('Error sending image:', error);
+    }
+}
+
+// --- GIF Modal Logic (Tenor) ---
+function openGifModal() {
+    if (!TENOR_API_KEY) {
+        alert("Please set your Tenor API key in the script to enable GIFs.");
+        return;
+    }
+    gifModal.classList.remove('hidden');
+    gifSearchInput.focus();
+    searchGifs('featured');
+}
+
+async function searchGifs(queryType = 'search') {
+    const query = gifSearchInput.value.trim();
+    const isSearching = queryType === 'search' && query !== '';
+    const endpoint = isSearching ? 'search' : 'featured';
+    
+    const params = new URLSearchParams({
+        key: TENOR_API_KEY,
+        client_key: TENOR_CLIENT_KEY,
+        limit: 24,
+    });
+    if (isSearching) params.append('q', query);
+    
+    gifResults.innerHTML = '<p class="text-center col-span-full">Loading...</p>';
+
+    try {
+        const response = await fetch(`https://tenor.googleapis.com/v2/${endpoint}?${params}`);
+        if (!response.ok) throw new Error('Tenor API request failed');
+        const result = await response.json();
+        
+        gifResults.innerHTML = '';
+        (result.results || []).forEach(gif => {
+            const gifItem = document.createElement('div');
+            gifItem.className = 'gif-item bg-gray-700 rounded-lg overflow-hidden';
+            const url = gif?.media_formats?.gif?.url || '';
+            const desc = gif?.content_description || 'GIF';
+            if (!url) return;
+            gifItem.innerHTML = `<img src="${url}" alt="${desc}" class="w-full h-full object-cover">`;
+            gifItem.onclick = () => selectGif(url);
+            gifResults.appendChild(gifItem);
+        });
+    } catch (error) {
+        gifResults.innerHTML = `<p class="text-center col-span-full text-red-400">Failed to load GIFs: ${error.message}</p>`;
+        console.error("Tenor API Error:", error);
+    }
+}
+
+function selectGif(gifUrl) {
+    if (!gifUrl) return;
+    sendMessage(gifUrl);
+    gifModal.classList.add('hidden');
+    gifSearchInput.value = '';
+}
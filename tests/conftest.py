@@ -0,0 +1,54 @@
+# conftest.py
+# Tests run app.py in this process (single-process LocalBroker, memory only) and talk to it with
+# Flask's test client. Each test starts from an empty store; tests that need CHAT_DATA_DIR or a
+# broker hub set them up themselves.
+
+import os
+import sys
+import threading
+
+import bcrypt
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.pop('CHAT_BROKER', None)
+os.environ.pop('CHAT_DATA_DIR', None)
+os.environ['CHAT_SECRET_KEY'] = 'test-secret'
+
+import app as chat
+
+# Logs are only fsynced (and posts acknowledged) by this thread, which the app starts only when
+# CHAT_DATA_DIR is set at import
+threading.Thread(target=chat.sync_logs_forever, daemon=True).start()
+
+# bcrypt's cheapest cost, so creating groups doesn't slow the tests down
+PASSWORD = 'secret'
+PASSWORD_HASH = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(4)).decode()
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """app.py with no groups, nothing loaded and hibernated groups spilled under tmp_path."""
+    with chat.store_lock:
+        chat.groups.clear()
+        chat.messages.clear()
+        chat.message_logs.clear()
+        chat.ingest_queues.clear()
+        chat.response_cache.clear()
+    chat.join_buckets.clear()
+    monkeypatch.setattr(chat, 'DATA_DIR', None)
+    monkeypatch.setattr(chat, 'spill_dir', str(tmp_path))
+    return chat
+
+@pytest.fixture
+def client(store):
+    return store.app.test_client()
+
+def create_group(name, session_key='k1'):
+    """Creates and loads `name` (password PASSWORD) and returns a session token for it."""
+    chat.broker.update_group(name, {'password_hash': PASSWORD_HASH, 'session_key': session_key})
+    chat.open_group(name)
+    return chat.session_tokens.dumps({'group': name, 'key': session_key})
+
+def auth(token):
+    return {'Authorization': f'Bearer {token}'}
@@ -0,0 +1,166 @@
+import hashlib
+import hmac
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import broker
+from conftest import PASSWORD_HASH, ROOT, auth
+
+class Recorder:
+    """Stands in for a worker's app module and records what the hub sends it."""
+
+    def __init__(self):
+        self.registry = None
+        self.messages = []
+        self.changed = threading.Condition()
+
+    def apply_registry(self, registry, snapshots):
+        self.registry = registry
+
+    def apply_messages(self, group, records):
+        with self.changed:
+            self.messages.extend((group, record['text']) for record in records)
+            self.changed.notify_all()
+
+    def apply_group(self, name, entry):
+        pass
+
+    def apply_snapshot(self, group, snapshot):
+        pass
+
+@pytest.fixture
+def hub(tmp_path):
+    """A `python broker.py` hub in a subprocess, with its own data dir. Yields its address."""
+    path = tmp_path / 'hub.sock'
+    env = dict(os.environ, CHAT_DATA_DIR=str(tmp_path / 'data'))
+    env.pop('CHAT_BROKER', None)
+    process = subprocess.Popen([sys.executable, 'broker.py', '--listen', f'unix:{path}'], cwd=ROOT, env=env)
+    try:
+        deadline = time.monotonic() + 30
+        while not path.exists():
+            assert process.poll() is None, 'hub exited'
+            assert time.monotonic() < deadline, 'hub did not start'
+            time.sleep(0.05)
+        yield f'unix:{path}'
+    finally:
+        process.terminate()
+        process.wait()
+
+@pytest.fixture
+def worker(store, hub, monkeypatch):
+    """This process's app, as a worker of `hub`."""
+    socket_broker = broker.SocketBroker(hub, store)
+    monkeypatch.setattr(store, 'broker', socket_broker)
+    socket_broker.start()
+    assert socket_broker.connected.is_set()
+    return socket_broker
+
+def test_post_round_trip(client, store, worker, hub):
+    other = broker.SocketBroker(hub, Recorder())
+    other.start()
+    worker.update_group('team', {'password_hash': PASSWORD_HASH, 'session_key': 'k1'})
+    token = store.session_tokens.dumps({'group': 'team', 'key': 'k1'})
+
+    response = client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': 'hi'}, headers=auth(token))
+
+    assert response.status_code == 201
+    page = client.get('/messages?group=team', headers=auth(token)).get_json()
+    assert [m['text'] for m in page['messages']][-1] == 'hi'
+    assert page['cursor'] == response.get_json()['id']
+    # Fanned out to the other worker, too
+    with other.store.changed:
+        assert other.store.changed.wait_for(lambda: ('team', 'hi') in other.store.messages, 5)
+
+def test_failed_request_keeps_the_connection(client, store, worker):
+    worker.update_group('team', {'password_hash': PASSWORD_HASH, 'session_key': 'k1'})
+    token = store.session_tokens.dumps({'group': 'team', 'key': 'k1'})
+    store.open_group('team')
+    sock = worker.sock
+
+    # Sent straight to the hub, past the worker's own checks
+    with pytest.raises(broker.BrokerUnavailable, match='ValueError'):
+        worker.request({'op': 'post', 'group': 'team', 'entries': [['alice', 5, None]]})
+    with pytest.raises(broker.BrokerUnavailable, match='TypeError'):
+        worker.request({'op': 'post', 'group': 'team', 'entries': [5]})
+
+    assert worker.sock is sock and worker.connected.is_set()
+    response = client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': 'hi'}, headers=auth(token))
+    assert response.status_code == 201
+
+@pytest.fixture
+def local_hub(store):
+    """A BrokerHub serving this process's store over a socket pair. Yields (send, read acks) for the worker end."""
+    hub = broker.BrokerHub(store)
+    hub_end, worker_end = socket.socketpair()
+    threading.Thread(target=hub.serve, args=(hub_end,), daemon=True).start()
+    stream = worker_end.makefile('rb')
+    challenge, _ = broker.read_frame(stream)
+    broker.send_frame(worker_end, {'op': 'auth', 'mac': broker.challenge_response(challenge['nonce'])})
+    assert broker.read_frame(stream)[0]['op'] == 'snapshot'
+
+    def read_ack():
+        while True:
+            header, _ = broker.read_frame(stream)
+            if header['op'] == 'ack':
+                return header
+
+    try:
+        yield (lambda header: broker.send_frame(worker_end, header)), read_ack
+    finally:
+        worker_end.close()
+        store.message_listeners.remove(hub.fan_out)
+        store.group_listeners.remove(hub.fan_out_group)
+
+def test_slow_request_does_not_hold_up_the_next(store, local_hub, monkeypatch):
+    send, read_ack = local_hub
+    store.broker.update_group('slow', {'password_hash': PASSWORD_HASH, 'session_key': ''})
+    store.broker.update_group('team', {'password_hash': PASSWORD_HASH, 'session_key': ''})
+    store.open_group('team')
+    release = threading.Event()
+    open_group = store.open_group
+
+    def slow_open_group(group):
+        if group == 'slow':
+            release.wait(10)
+        return open_group(group)
+
+    monkeypatch.setattr(store, 'open_group', slow_open_group)
+
+    send({'op': 'load', 'group': 'slow', 'req': 1})
+    send({'op': 'post', 'group': 'team', 'entries': [['alice', 'hi', None]], 'req': 2})
+
+    first = read_ack()
+    release.set()
+    second = read_ack()
+    assert first['req'] == 2 and first['messages'][0]['text'] == 'hi'
+    assert second['req'] == 1 and 'snapshot' in second
+
+def test_unknown_op_is_an_error(store, local_hub):
+    send, read_ack = local_hub
+    send({'op': 'bogus', 'req': 7})
+    ack = read_ack()
+    assert ack['req'] == 7 and 'error' in ack
+
+def test_worker_without_the_key_is_refused(store):
+    hub = broker.BrokerHub(store)
+    hub_end, worker_end = socket.socketpair()
+    serving = threading.Thread(target=hub.serve, args=(hub_end,), daemon=True)
+    serving.start()
+    stream = worker_end.makefile('rb')
+    challenge, _ = broker.read_frame(stream)
+    wrong = hmac.new(b'wrong key', challenge['nonce'].encode(), hashlib.sha256).hexdigest()
+    broker.send_frame(worker_end, {'op': 'auth', 'mac': wrong})
+
+    # Closed without a snapshot, and never subscribed
+    with pytest.raises(EOFError):
+        broker.read_frame(stream)
+    serving.join(5)
+    assert not hub.outboxes
+    store.message_listeners.remove(hub.fan_out)
+    store.group_listeners.remove(hub.fan_out_group)
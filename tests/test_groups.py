@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import PASSWORD, auth, create_group
+
+@pytest.fixture(params=['spill', 'data_dir'])
+def persistence(request, store, monkeypatch, tmp_path):
+    """Runs a test with hibernated groups spilled to a temp file, and again with CHAT_DATA_DIR set."""
+    if request.param == 'data_dir':
+        monkeypatch.setattr(store, 'DATA_DIR', str(tmp_path / 'data'))
+    return request.param
+
+def post(client, token, text, group='team'):
+    response = client.post('/messages', json={'group': group, 'username': 'alice', 'text': text}, headers=auth(token))
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+def page(client, token, group='team'):
+    return client.get(f'/messages?group={group}', headers=auth(token)).get_json()['messages']
+
+def hibernate(store, group):
+    store.messages[group].touched -= 2 * store.GROUP_IDLE_SECONDS
+    store.hibernate_idle_groups()
+
+def test_hibernate_and_wake(client, store, persistence):
+    token = create_group('team')
+    ids = [post(client, token, f'm{i}') for i in range(3)]
+    before = page(client, token)
+
+    hibernate(store, 'team')
+    assert 'team' not in store.messages
+
+    # The next request wakes the group with the same messages and ids (and no second welcome)
+    assert page(client, token) == before
+    assert post(client, token, 'after') == ids[-1] + 1
+
+def test_busy_group_is_not_hibernated(client, store):
+    token = create_group('team')
+    post(client, token, 'hi')
+    store.hibernate_idle_groups()
+    assert 'team' in store.messages
+
+def test_open_waits_while_the_group_is_put_away(client, store, persistence, monkeypatch):
+    token = create_group('team')
+    for i in range(3):
+        post(client, token, f'm{i}')
+    before = page(client, token)
+    write_file_atomically = store.write_file_atomically
+    writing = threading.Event()
+
+    def slow_write(path, data):
+        writing.set()
+        time.sleep(0.3)
+        write_file_atomically(path, data)
+
+    monkeypatch.setattr(store, 'write_file_atomically', slow_write)
+    hibernating = threading.Thread(target=hibernate, args=(store, 'team'))
+    hibernating.start()
+    writing.wait(5)
+
+    # Arrives while the history is being written out
+    assert page(client, token) == before
+    hibernating.join()
+    assert page(client, token) == before
+
+def test_deleted_and_recreated_group_starts_afresh(client, store):
+    token = create_group('team')
+    post(client, token, 'old')
+    page(client, token)
+
+    store.broker.update_group('team', None)
+    token = create_group('team', session_key='k2')
+
+    assert [m['text'] for m in page(client, token)] == ['Welcome to the team group! Say hi 👋']
+
+def test_failed_hibernation_keeps_the_group(client, store, persistence, monkeypatch):
+    token = create_group('team')
+    post(client, token, 'hi')
+    before = page(client, token)
+    write_file_atomically = store.write_file_atomically
+
+    def disk_full(path, data):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(store, 'write_file_atomically', disk_full)
+    hibernate(store, 'team')
+    assert 'team' in store.messages
+    assert page(client, token) == before
+
+    # Put away on a later try
+    monkeypatch.setattr(store, 'write_file_atomically', write_file_atomically)
+    hibernate(store, 'team')
+    assert 'team' not in store.messages
+    assert page(client, token) == before
+
+def test_group_deleted_while_loading_stays_deleted(client, store, persistence, monkeypatch, tmp_path):
+    token = create_group('team')
+    post(client, token, 'old')
+    hibernate(store, 'team')
+    restore_snapshot = store.restore_snapshot
+    reading, release = threading.Event(), threading.Event()
+
+    def slow_restore(history, snapshot):
+        reading.set()
+        release.wait(5)
+        restore_snapshot(history, snapshot)
+
+    monkeypatch.setattr(store, 'restore_snapshot', slow_restore)
+    loading = threading.Thread(target=store.open_group, args=('team',))
+    loading.start()
+    assert reading.wait(5)
+    deleting = threading.Thread(target=store.broker.update_group, args=('team', None))
+    deleting.start()
+    while 'team' in store.groups:
+        time.sleep(0.01)
+    release.set()
+    loading.join()
+    deleting.join()
+
+    assert 'team' not in store.messages and 'team' not in store.message_logs
+    assert not os.path.exists(os.path.join(tmp_path, 'data', 'groups', 'team'))
+    assert not os.path.exists(store.spill_path('team'))
+    token = create_group('team', session_key='k2')
+    assert [m['text'] for m in page(client, token)] == ['Welcome to the team group! Say hi 👋']
+
+@pytest.fixture
+def admin(store, monkeypatch):
+    monkeypatch.setattr(store, 'ADMIN_TOKEN', 'admin-token')
+    return {'Authorization': 'Bearer admin-token'}
+
+def test_new_password_ends_sessions(client, store, admin):
+    token = create_group('team')
+    session = store.read_session(token)
+
+    response = client.put('/admin/groups/team/password', json={'password': 'new password'}, headers=admin)
+
+    assert response.status_code == 200
+    assert client.get('/messages?group=team', headers=auth(token)).status_code == 401
+    # Open streams and sockets check the session they started with as they go
+    assert not store.session_current(session)
+    joined = client.get('/check_group?name=team&password=new%20password').get_json()
+    assert client.get('/messages?group=team', headers=auth(joined['token'])).status_code == 200
+
+def test_old_password_is_refused_after_a_change(client, store, admin):
+    create_group('team')
+    client.put('/admin/groups/team/password', json={'password': 'new password'}, headers=admin)
+    assert client.get(f'/check_group?name=team&password={PASSWORD}').status_code == 401
+
+def test_deleting_a_group_ends_its_stream(client, store, admin):
+    token = create_group('team')
+    response = client.get(f'/stream?group=team&token={token}', buffered=False)
+    events = response.response
+    assert next(events).startswith(b'event: presence')
+
+    ended = threading.Event()
+
+    def read_rest():
+        for _ in events:
+            pass
+        ended.set()
+
+    threading.Thread(target=read_rest, daemon=True).start()
+    assert client.delete('/admin/groups/team', headers=admin).status_code == 200
+    assert ended.wait(5)
+    response.close()
@@ -0,0 +1,35 @@
+import io
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import images
+from conftest import auth, create_group
+
+Image = pytest.importorskip('PIL.Image')
+
+def png(width, height):
+    out = io.BytesIO()
+    Image.new('L', (width, height)).save(out, 'PNG')
+    return out.getvalue()
+
+def test_image_over_the_pixel_limit_is_refused(monkeypatch):
+    monkeypatch.setattr(images, 'MAX_IMAGE_PIXELS', 1000)
+    # Over the limit, but under the twice-the-limit Pillow refuses by itself
+    with pytest.raises(ValueError, match='too large'):
+        images.process_image(png(40, 30), 'image/png')
+    assert len(images.process_image(png(40, 25), 'image/png')) == 2
+
+def test_upload_after_an_image_process_died(client, store):
+    token = create_group('team')
+    broken = store.image_pool
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result(10)
+
+    response = client.post('/upload_image', headers=auth(token), data={
+        'image': (io.BytesIO(png(40, 30)), 'a.png', 'image/png'), 'username': 'alice', 'group': 'team',
+    })
+
+    assert response.status_code == 201
+    assert store.image_pool is not broken
@@ -0,0 +1,104 @@
+import errno
+import os
+
+from conftest import auth, create_group
+
+def new_history(store):
+    return store.MessageHistory(store.MAX_MESSAGES_PER_GROUP, store.MAX_BYTES_PER_GROUP)
+
+def write(store, log, history, texts):
+    """Appends messages the way store_messages does and waits until they're on disk."""
+    with store.store_lock:
+        batch = []
+        for text in texts:
+            message = store.Message(history.last_id + 1, 'alice', text, 0)
+            history.last_id = message.id
+            history.append(message)
+            batch.append(message)
+        log.write(batch)
+    log.sync(history)
+
+def texts(history):
+    return [message.text for message in history.after(0, history.count)]
+
+def test_recovery_drops_a_torn_record(store, tmp_path):
+    history = new_history(store)
+    log = store.MessageLog(tmp_path, history)
+    write(store, log, history, ['one', 'two', 'three'])
+    log.file.close()
+    size = os.path.getsize(log.log_path)
+    # A crash in the middle of an append: the header promises more bytes than made it to disk
+    with open(log.log_path, 'ab') as f:
+        f.write(store.RECORD_HEADER.pack(100) + b'{"id":4,"use')
+
+    recovered = new_history(store)
+    log = store.MessageLog(tmp_path, recovered)
+
+    assert texts(recovered) == ['one', 'two', 'three']
+    assert recovered.last_id == 3
+    assert os.path.getsize(log.log_path) == size
+    # Appends after recovery follow the last good record
+    write(store, log, recovered, ['four'])
+    log.file.close()
+    reopened = new_history(store)
+    store.MessageLog(tmp_path, reopened).file.close()
+    assert texts(reopened) == ['one', 'two', 'three', 'four']
+
+def test_recovery_drops_a_torn_header(store, tmp_path):
+    history = new_history(store)
+    log = store.MessageLog(tmp_path, history)
+    write(store, log, history, ['one'])
+    log.file.close()
+    with open(log.log_path, 'ab') as f:
+        f.write(b'\x00\x00')
+
+    recovered = new_history(store)
+    store.MessageLog(tmp_path, recovered).file.close()
+
+    assert texts(recovered) == ['one']
+
+def test_recovery_replays_only_records_after_the_snapshot(store, tmp_path):
+    history = new_history(store)
+    log = store.MessageLog(tmp_path, history)
+    write(store, log, history, ['one', 'two'])
+    log.sync(history, snapshot=True)
+    write(store, log, history, ['three'])
+    log.file.close()
+
+    recovered = new_history(store)
+    log = store.MessageLog(tmp_path, recovered)
+
+    assert log.records_since_snapshot == 1
+    assert texts(recovered) == ['one', 'two', 'three']
+
+def test_closed_log_reopens_from_its_snapshot(store, tmp_path):
+    history = new_history(store)
+    log = store.MessageLog(tmp_path, history)
+    write(store, log, history, ['one', 'two'])
+    log.close(history)
+
+    recovered = new_history(store)
+    log = store.MessageLog(tmp_path, recovered)
+
+    assert log.records_since_snapshot == 0
+    assert texts(recovered) == ['one', 'two']
+    assert recovered.last_id == 2
+
+def test_failed_sync_fails_the_post_and_the_next_one_succeeds(client, store, tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'DATA_DIR', str(tmp_path))
+    token = create_group('team')
+    fsync = os.fsync
+
+    def disk_full(fd):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(os, 'fsync', disk_full)
+    response = client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': 'one'}, headers=auth(token))
+    assert response.status_code == 503
+
+    # The sync thread keeps going once the disk has room again
+    monkeypatch.setattr(os, 'fsync', fsync)
+    response = client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': 'two'}, headers=auth(token))
+    assert response.status_code == 201
+    log = store.message_logs['team']
+    assert log.synced == log.written
@@ -0,0 +1,163 @@
+import threading
+import time
+
+import pytest
+
+from conftest import auth, create_group
+
+@pytest.mark.parametrize('text', [123, None, '', ['hi'], {'a': 1}])
+def test_post_rejects_text_that_is_not_a_string(client, store, text):
+    token = create_group('team')
+    history = store.messages['team']
+    before = (history.last_id, history.count, history.bytes, history.version)
+
+    response = client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': text}, headers=auth(token))
+
+    assert response.status_code == 400
+    assert (history.last_id, history.count, history.bytes, history.version) == before
+
+def test_post_rejects_username_that_is_not_a_string(client):
+    token = create_group('team')
+    response = client.post('/messages', json={'group': 'team', 'username': 5, 'text': 'hi'}, headers=auth(token))
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('path, extra', [
+    ('/messages', {'username': 'alice', 'text': 'hi'}),
+    ('/messages/batch', {'messages': [{'username': 'alice', 'text': 'hi'}]}),
+])
+@pytest.mark.parametrize('group', [['team'], {'team': 1}, 5, None])
+def test_post_rejects_group_that_is_not_a_string(client, path, extra, group):
+    token = create_group('team')
+    response = client.post(path, json=dict(extra, group=group), headers=auth(token))
+    assert response.status_code == 400
+
+def test_rejected_post_does_not_break_eviction(client, store, monkeypatch):
+    monkeypatch.setattr(store, 'MAX_MESSAGES_PER_GROUP', 5)
+    token = create_group('team')
+    client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': 7}, headers=auth(token))
+
+    ids = []
+    for i in range(8):
+        response = client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': f'm{i}'}, headers=auth(token))
+        assert response.status_code == 201
+        ids.append(response.get_json()['id'])
+
+    page = client.get('/messages?group=team', headers=auth(token)).get_json()
+    assert [m['id'] for m in page['messages']] == ids[-5:]
+    assert [m['text'] for m in page['messages']] == ['m3', 'm4', 'm5', 'm6', 'm7']
+
+def test_history_size_is_unchanged_when_a_message_cannot_be_sized(store):
+    history = store.MessageHistory(3, 1024 * 1024)
+    history.append(store.Message(1, 'alice', 'hi', 0))
+    before = (history.count, history.bytes, history.version, history.start)
+
+    with pytest.raises(AttributeError):
+        history.append(store.Message(2, 'alice', 5, 0))
+
+    assert (history.count, history.bytes, history.version, history.start) == before
+
+def test_batch_with_an_invalid_message_stores_nothing(client, store):
+    token = create_group('team')
+    last_id = store.messages['team'].last_id
+
+    response = client.post('/messages/batch', headers=auth(token), json={'group': 'team', 'messages': [
+        {'username': 'alice', 'text': 'hi'},
+        {'username': 'bob', 'text': None},
+    ]})
+
+    assert response.status_code == 400
+    assert store.messages['team'].last_id == last_id
+
+def coalesced_posts(store, monkeypatch, posts):
+    """Runs append_messages for each (name, entries) at once, so they share a batch. Returns name -> ids or error."""
+    publish = store.broker.publish
+    first_batch_started = threading.Event()
+
+    def slow_publish(group, entries):
+        # Holds the first batch open so the other posts queue up behind it
+        first_batch_started.set()
+        time.sleep(0.2)
+        return publish(group, entries)
+
+    monkeypatch.setattr(store.broker, 'publish', slow_publish)
+    results = {}
+
+    def post(name, entries):
+        try:
+            results[name] = [message.id for message in store.append_messages('team', entries)]
+        except Exception as e:
+            results[name] = e
+
+    leader = threading.Thread(target=post, args=('leader', [('leader', 'first', None)]))
+    leader.start()
+    first_batch_started.wait()
+    threads = [threading.Thread(target=post, args=post_args) for post_args in posts]
+    for thread in threads:
+        thread.start()
+    for thread in [leader] + threads:
+        thread.join()
+    return results
+
+def test_invalid_entry_only_fails_its_own_post(store, monkeypatch):
+    create_group('team')
+    results = coalesced_posts(store, monkeypatch, [
+        ('alice', [('alice', 'hi', None)]),
+        ('bad', [('bad', 5, None)]),
+        ('bob', [('bob', 'one', None), ('bob', 'two', None)]),
+    ])
+
+    assert isinstance(results['bad'], ValueError)
+    stored = {message.id: message.text for message in store.messages['team'].after(0, 100)}
+    assert [stored[i] for i in results['alice']] == ['hi']
+    assert [stored[i] for i in results['bob']] == ['one', 'two']
+
+def test_failed_batch_is_retried_per_post(store, monkeypatch):
+    create_group('team')
+    message_class = store.Message
+
+    class FailingMessage(message_class):
+        __slots__ = ()
+
+        def __init__(self, message_id, username, text, created, full=None):
+            if text == 'boom':
+                raise RuntimeError('boom')
+            super().__init__(message_id, username, text, created, full)
+
+    monkeypatch.setattr(store, 'Message', FailingMessage)
+    results = coalesced_posts(store, monkeypatch, [
+        ('alice', [('alice', 'hi', None)]),
+        ('bad', [('bad', 'boom', None)]),
+        ('bob', [('bob', 'yo', None)]),
+    ])
+
+    assert isinstance(results['bad'], RuntimeError)
+    history = store.messages['team']
+    texts = [message.text for message in history.after(0, 100)]
+    # Everyone else's message was stored once, and ids stayed contiguous
+    assert texts.count('hi') == 1 and texts.count('yo') == 1
+    assert [history.get(i).text for i in results['alice'] + results['bob']] == ['hi', 'yo']
+    assert history.count == history.last_id
+
+def test_resent_post_with_the_same_key_is_stored_once(client, store):
+    token = create_group('team')
+    post = {'group': 'team', 'username': 'alice', 'text': 'hi', 'key': 'c1:1'}
+
+    first = client.post('/messages', json=post, headers=auth(token))
+    again = client.post('/messages', json=post, headers=auth(token))
+    other = client.post('/messages', json=dict(post, key='c1:2'), headers=auth(token))
+
+    assert first.status_code == again.status_code == other.status_code == 201
+    assert again.get_json()['id'] == first.get_json()['id']
+    assert other.get_json()['id'] == first.get_json()['id'] + 1
+    texts = [message.text for message in store.messages['team'].after(0, 100)]
+    assert texts.count('hi') == 2
+
+def test_same_key_twice_in_one_batch_is_stored_once(store, monkeypatch):
+    create_group('team')
+    results = coalesced_posts(store, monkeypatch, [
+        ('socket', [('alice', 'hi', None, 'c1:1')]),
+        ('http', [('alice', 'hi', None, 'c1:1')]),
+    ])
+
+    assert results['socket'] == results['http']
+    assert store.messages['team'].count == store.messages['team'].last_id
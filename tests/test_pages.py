@@ -0,0 +1,79 @@
+from conftest import auth, create_group
+
+def post(client, token, text):
+    response = client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': text}, headers=auth(token))
+    return response.get_json()['id']
+
+def test_unchanged_page_is_not_modified(client, store):
+    token = create_group('team')
+    first = client.get('/messages?group=team', headers=auth(token))
+    etag = first.headers['ETag']
+
+    again = client.get('/messages?group=team', headers=dict(auth(token), **{'If-None-Match': etag}))
+
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+
+def test_new_message_changes_the_etag(client, store):
+    token = create_group('team')
+    etag = client.get('/messages?group=team', headers=auth(token)).headers['ETag']
+    post(client, token, 'hi')
+
+    response = client.get('/messages?group=team', headers=dict(auth(token), **{'If-None-Match': etag}))
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()['messages'][-1]['text'] == 'hi'
+
+def page(client, token, query):
+    return client.get(f'/messages?group=team&{query}', headers=auth(token)).get_json()
+
+def test_before_pages_back_to_the_oldest_message(client, store):
+    token = create_group('team')
+    ids = [1] + [post(client, token, f'm{i}') for i in range(10)]
+
+    latest = page(client, token, 'limit=4')
+    older = page(client, token, f"limit=4&before={latest['before']}")
+    oldest = page(client, token, f"limit=4&before={older['before']}")
+
+    assert [m['id'] for m in latest['messages']] == ids[-4:]
+    assert latest['older'] and not latest['more']
+    assert [m['id'] for m in older['messages']] == ids[-8:-4]
+    assert older['older'] and older['before'] == ids[-8]
+    assert [m['id'] for m in oldest['messages']] == ids[:-8]
+    assert not oldest['older']
+
+def test_before_stops_at_evicted_messages(client, store, monkeypatch):
+    monkeypatch.setattr(store, 'MAX_MESSAGES_PER_GROUP', 5)
+    token = create_group('team')
+    ids = [post(client, token, f'm{i}') for i in range(8)]
+
+    response = page(client, token, f'limit=10&before={ids[-2]}')
+
+    assert [m['id'] for m in response['messages']] == ids[-5:-2]
+    assert not response['older']
+    assert page(client, token, f'before={ids[-5]}')['messages'] == []
+
+def test_compact_page_has_the_same_messages_as_rows(client, store):
+    token = create_group('team')
+    post(client, token, 'hi')
+    store.append_message('team', 'bob', '/media/thumb', '/media/full')
+    compact = {'Accept': store.COMPACT_MIMETYPE}
+
+    full = client.get('/messages?group=team', headers=auth(token))
+    rows = client.get('/messages?group=team', headers=dict(auth(token), **compact))
+
+    assert rows.mimetype == store.COMPACT_MIMETYPE
+    assert 'Accept' in rows.headers['Vary']
+    assert rows.headers['ETag'] != full.headers['ETag']
+    page = rows.get_json(force=True)
+    fields = page.pop('fields')
+    assert [dict(zip(fields, row)) for row in page.pop('messages')] == full.get_json()['messages']
+    assert page == {key: value for key, value in full.get_json().items() if key != 'messages'}
+
+def test_plain_json_is_the_default(client, store):
+    token = create_group('team')
+    response = client.get('/messages?group=team', headers=dict(auth(token), Accept='*/*'))
+    assert response.mimetype == 'application/json'
+    assert 'fields' not in response.get_json()
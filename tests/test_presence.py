@@ -0,0 +1,75 @@
+import time
+
+import presence
+from conftest import auth, create_group
+
+def test_keys_expire_after_their_deadline_second():
+    keys = presence.ExpiringSet()
+    assert keys.touch('a', 10.5)
+    assert keys.touch('b', 12.2)
+
+    assert keys.expire(10.9) == []
+    assert keys.expire(11.0) == ['a']
+    assert 'a' not in keys and 'b' in keys
+    assert keys.expire(13.0) == ['b']
+
+def test_touch_moves_the_deadline():
+    keys = presence.ExpiringSet()
+    keys.touch('a', 10.5)
+    assert not keys.touch('a', 20.5)
+
+    assert keys.expire(15.0) == []
+    assert keys.expire(21.0) == ['a']
+
+def test_discarded_key_does_not_expire():
+    keys = presence.ExpiringSet()
+    keys.touch('a', 10.5)
+    assert keys.discard('a')
+    assert not keys.discard('a')
+    assert keys.expire(11.0) == []
+
+def test_first_sweep_expires_keys_already_due():
+    keys = presence.ExpiringSet()
+    keys.touch('a', 5.0)
+    assert keys.expire(100.0) == ['a']
+
+def test_expiry_after_a_long_idle_spell():
+    keys = presence.ExpiringSet()
+    keys.expire(0)
+    keys.touch('a', 5.0)
+    keys.touch('b', 10 ** 6)
+    assert keys.expire(10 ** 5) == ['a']
+
+def test_online_and_typing_expire_on_their_own_ttls():
+    tracker = presence.Presence(ttl=40, typing_ttl=6)
+    version = tracker.version('team')
+
+    assert tracker.seen('team', 'alice', typing=True, now=100)
+    assert tracker.summary('team') == {'online': ['alice'], 'typing': ['alice']}
+    assert tracker.version('team') != version
+
+    assert tracker.expire(now=108) == {'team'}
+    assert tracker.summary('team') == {'online': ['alice'], 'typing': []}
+    assert tracker.expire(now=142) == {'team'}
+    assert tracker.summary('team') == {'online': [], 'typing': []}
+
+def test_seen_again_only_changes_the_summary_when_something_shows():
+    tracker = presence.Presence(ttl=40, typing_ttl=6)
+    assert tracker.seen('team', 'alice', now=100)
+    version = tracker.version('team')
+
+    assert not tracker.seen('team', 'alice', now=101)
+    assert not tracker.seen('team', 'x' * (presence.MAX_NAME_LENGTH + 1), now=101)
+    assert tracker.version('team') == version
+    assert tracker.seen('team', 'alice', typing=True, now=102)
+    assert tracker.seen('team', 'alice', typing=False, now=103)
+    assert tracker.summary('team')['typing'] == []
+
+def test_presence_route_shows_who_polled(client, store, monkeypatch):
+    monkeypatch.setattr(store, 'presence_tracker', presence.Presence(store.PRESENCE_TTL, store.TYPING_TTL))
+    token = create_group('team')
+    client.get('/messages?group=team&username=bob', headers=auth(token))
+
+    assert client.get('/presence?group=team', headers=auth(token)).get_json() == {'online': ['bob'], 'typing': []}
+    store.presence_tracker.expire(now=time.monotonic() + store.PRESENCE_TTL + 2)
+    assert client.get('/presence?group=team', headers=auth(token)).get_json()['online'] == []
@@ -0,0 +1,59 @@
+import search
+from conftest import auth, create_group
+
+class Message:
+    def __init__(self, message_id, text):
+        self.id = message_id
+        self.text = text
+
+def index_of(*texts):
+    index = search.SearchIndex()
+    messages = [Message(i, text) for i, text in enumerate(texts, 1)]
+    for message in messages:
+        index.add(message)
+    return index, messages
+
+def test_every_word_matches_as_a_prefix():
+    index, _ = index_of('Hello world', 'help wanted', 'world peace', 'hello there, world')
+
+    assert index.search('hel', 100, 10) == [4, 2, 1]
+    assert index.search('WOR hel', 100, 10) == [4, 1]
+    assert index.search('nothing', 100, 10) == []
+    assert index.search('...', 100, 10) == []
+
+def test_media_messages_are_not_indexed():
+    index, _ = index_of('cat /media/abc123', 'https://media.tenor.com/cat.gif', 'my cat')
+    assert index.search('cat', 100, 10) == [3]
+
+def test_evicted_messages_drop_out():
+    index, messages = index_of('apple pie', 'apple tart', 'cherry pie')
+
+    index.remove_oldest(messages[0])
+
+    assert index.search('apple', 100, 10) == [2]
+    assert index.search('pie', 100, 10) == [3]
+    index.remove_oldest(messages[1])
+    assert index.search('apple', 100, 10) == []
+    assert 'apple' not in index.words and 'tart' not in index.postings
+
+def test_before_and_limit_page_through_older_matches():
+    index, _ = index_of(*[f'note {i}' for i in range(1, 8)])
+
+    assert index.search('note', 100, 3) == [7, 6, 5]
+    assert index.search('note', 5, 3) == [4, 3, 2]
+    assert index.search('note', 2, 3) == [1]
+
+def test_search_route_pages_and_follows_eviction(client, store, monkeypatch):
+    monkeypatch.setattr(store, 'MAX_MESSAGES_PER_GROUP', 6)
+    token = create_group('team')
+    for i in range(7):
+        client.post('/messages', json={'group': 'team', 'username': 'alice', 'text': f'note {i}'}, headers=auth(token))
+
+    first = client.get('/search?group=team&q=no&limit=4', headers=auth(token)).get_json()
+    rest = client.get(f"/search?group=team&q=no&limit=4&before={first['before']}", headers=auth(token)).get_json()
+
+    # The welcome message and note 0 have been evicted
+    assert [m['text'] for m in first['messages']] == ['note 6', 'note 5', 'note 4', 'note 3']
+    assert first['more']
+    assert [m['text'] for m in rest['messages']] == ['note 2', 'note 1']
+    assert not rest['more']